@@ -0,0 +1,40 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))), 'pdfprocessor'))
+from bulk_ingest import EMBED_BATCH_SIZE
+from pdf_processor import PDFBatchProcessor
+
+
+class Command(BaseCommand):
+    help = '批量入库目录树中的PDF，写入网页端共用的 processed_data（已入库的文件按内容哈希跳过）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('root', nargs='?', help='PDF所在目录（递归查找）')
+        parser.add_argument('--workers', type=int, default=None, help='提取进程数，默认 CPU核数-1')
+        parser.add_argument('--batch-size', type=int, default=EMBED_BATCH_SIZE, help='每批送入模型的文本块数')
+        parser.add_argument('--resume-uploads', action='store_true', help='先继续网页上传时中断的入库任务')
+
+    def handle(self, *args, **options):
+        root = options['root']
+        if root is None and not options['resume_uploads']:
+            raise CommandError('请指定PDF目录，或使用 --resume-uploads')
+        if root is not None and not os.path.isdir(root):
+            raise CommandError(f'目录不存在: {root}')
+
+        processor = PDFBatchProcessor()
+        if options['resume_uploads']:
+            count = processor.resume_interrupted()
+            self.stdout.write(f'已继续 {count} 个中断的上传任务')
+        if root is None:
+            return
+
+        # 进度行用回车刷新，直接写 sys.stdout（OutputWrapper 会给每次写入补换行）
+        summary = processor.process_directory(root, workers=options['workers'],
+                                              batch_size=options['batch_size'], stream=sys.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f"完成：共 {summary['total']} 个文件，新入库 {summary['ingested']}，跳过 {summary['skipped']}，"
+            f"失败 {summary['failed']}，{summary['pages']} 页 / {summary['chunks']} 个文本块，用时 {summary['seconds']} 秒"
+        ))
@@ -0,0 +1,202 @@
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseNotModified,
+                         StreamingHttpResponse)
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_http_methods
+
+# 流式读取时的块大小
+STREAM_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _make_etag(stat_result) -> str:
+    """根据文件大小和修改时间生成强ETag"""
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """判断If-None-Match / If-Range 中是否包含当前ETag"""
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+
+def _parse_range(header: str, size: int):
+    """解析单个字节范围，返回 (start, end)；无法满足时返回 None，多段范围返回 'full'"""
+    if ',' in header:
+        # 多段范围请求直接返回整个文件（RFC 7233 允许）
+        return 'full'
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return 'full'
+    start, end = match.groups()
+    if start == '' and end == '':
+        return 'full'
+    if start == '':
+        # 后缀范围: bytes=-500 表示最后500字节
+        length = int(end)
+        if length == 0:
+            return None
+        start = max(size - length, 0)
+        end = size - 1
+    else:
+        start = int(start)
+        end = int(end) if end else size - 1
+        end = min(end, size - 1)
+    if start >= size or start > end:
+        return None
+    return start, end
+
+
+def _iter_file_range(file_path: str, start: int, length: int):
+    """按块读取文件中指定的字节区间"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+async def _aiter_file_range(file_path: str, start: int, length: int):
+    """
+    _iter_file_range 的异步版本，供ASGI使用：ASGI下Django会把同步迭代器整体读入内存后才开始发送。
+    读文件放到线程池中执行，不占用事件循环，也不占用同步视图共用的线程。
+    """
+    read = sync_to_async(_read_block, thread_sensitive=False)
+    f = await sync_to_async(open, thread_sensitive=False)(file_path, 'rb')
+    try:
+        offset = start
+        remaining = length
+        while remaining > 0:
+            data = await read(f, offset, min(STREAM_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            offset += len(data)
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _read_block(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _sendfile_response(request_path: str, file_path: str, accel_prefix=None):
+    """
+    交给前端服务器（Apache/Nginx）直接发送文件。
+    accel_prefix 为该文件根目录对应的 Nginx internal location，每个根目录各用一个，
+    未指定时使用 MEDIA_ACCEL_REDIRECT_PREFIX。
+    路径按URL百分号编码：中文文件名原样写入时Django会把响应头MIME编码（=?utf-8?b?...?=），
+    前端服务器无法据此找到文件。Nginx 会先解码 X-Accel-Redirect 的URI，
+    mod_xsendfile 默认（XSendFileUnescape On）也会解码 X-Sendfile 的路径。
+    """
+    backend = getattr(settings, 'MEDIA_SENDFILE_BACKEND', None)
+    if backend == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = quote(file_path)
+        return response
+    if backend == 'x-accel-redirect':
+        prefix = accel_prefix or getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected/')
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = quote(posixpath.join(prefix, request_path.lstrip('/')))
+        return response
+    return None
+
+
+def _set_cache_headers(response, etag: str, stat_result, content_type: str):
+    response['Content-Type'] = content_type
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat_result.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = getattr(settings, 'MEDIA_CACHE_CONTROL', 'private, max-age=3600')
+    return response
+
+
+@require_http_methods(['GET', 'HEAD'])
+def serve_media(request, path, document_root=None, accel_prefix=None):
+    """
+    替代 django.views.static.serve 的媒体文件视图。
+    支持 Range 分段下载（PDF.js 按需加载页面）、ETag / If-None-Match 缓存校验，
+    以及可选的 X-Sendfile / X-Accel-Redirect 转发（accel_prefix 与 document_root 一起在URL参数中指定）。
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        file_path = safe_join(os.fspath(document_root), path)
+    except Exception:
+        raise Http404('文件不存在')
+    if not os.path.isfile(file_path):
+        raise Http404('文件不存在')
+
+    stat_result = os.stat(file_path)
+    size = stat_result.st_size
+    etag = _make_etag(stat_result)
+    content_type, encoding = mimetypes.guess_type(file_path)
+    content_type = content_type or 'application/octet-stream'
+
+    # 缓存校验：If-None-Match 优先于 If-Modified-Since
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return _set_cache_headers(HttpResponseNotModified(), etag, stat_result, content_type)
+    else:
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        if since is not None and int(stat_result.st_mtime) <= since:
+            return _set_cache_headers(HttpResponseNotModified(), etag, stat_result, content_type)
+
+    # 由前端服务器负责发送（它们自行处理 Range）
+    offloaded = _sendfile_response(path, file_path, accel_prefix)
+    if offloaded is not None:
+        return _set_cache_headers(offloaded, etag, stat_result, content_type)
+
+    byte_range = 'full'
+    range_header = request.headers.get('Range')
+    if range_header:
+        # If-Range 不匹配时返回整个文件
+        if_range = request.headers.get('If-Range')
+        if if_range is None or _etag_matches(if_range, etag):
+            byte_range = _parse_range(range_header, size)
+
+    if byte_range is None:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return _set_cache_headers(response, etag, stat_result, content_type)
+
+    asgi = isinstance(request, ASGIRequest)
+    if byte_range == 'full':
+        if request.method == 'HEAD':
+            response = HttpResponse()
+        elif asgi:
+            response = StreamingHttpResponse(_aiter_file_range(file_path, 0, size))
+        else:
+            # FileResponse 可以利用 wsgi.file_wrapper（sendfile）零拷贝发送
+            response = FileResponse(open(file_path, 'rb'))
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        if request.method == 'HEAD':
+            response = HttpResponse(status=206)
+        else:
+            iterator = (_aiter_file_range if asgi else _iter_file_range)(file_path, start, length)
+            response = StreamingHttpResponse(iterator, status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(length)
+
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return _set_cache_headers(response, etag, stat_result, content_type)
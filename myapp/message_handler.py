@@ -1,9 +1,27 @@
 import os
 import json
 import sys
+import asyncio
+import httpx
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'pdfprocessor'))
+from spec_index import SpecIndex
+from embedding_store import load_embeddings, manifest_path
+from shared_store import GenerationCounter
+from single_flight import SingleFlight, normalize_question
+from llm_guard import LLMUnavailable, get_llm_guard, raise_for_upstream_status
+from async_http import LoopLocalClient, close_async_clients
+
+# 提示词中最多使用的文档字符数（见 call_deepseek_api）
+DOCUMENT_CONTENT_LIMIT = 8000
+# 异步视图中执行CPU密集任务（向量化、检索、索引查询）的有界线程池
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='cpu')
+# 异步HTTP客户端的最大并发连接数
+ASYNC_MAX_CONNECTIONS = 200
+
 class MessageHandler:
     def __init__(self):
         # DeepSeek API配置
@@ -17,69 +35,113 @@ class MessageHandler:
         
         # DeepSeek API 地址
         self.api_url = "https://api.deepseek.com/v1/chat/completions"
+        # 异步调用使用的HTTP客户端：常驻事件循环上复用连接池，每请求一个循环时用完即关
+        self.async_http = LoopLocalClient(
+            verify=False,  # 与同步调用一致，禁用SSL验证（仅用于开发环境）
+            timeout=30,
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS)
+        )
+        # 合并同一文档版本下的相同并发问题
+        self.flight = SingleFlight()
+        # 进程内共享的DeepSeek并发限制和熔断器
+        self.guard = get_llm_guard()
         
+        # 多进程共享的代数计数器，入库进程发布新数据后各worker据此重新加载
+        self.generations = GenerationCounter(self.data_dir())
+        self.loaded_generations = self.current_generations()
         # 从文件加载文档内容
         self.document_content = self.load_document_content()
+        # 规格索引，用于直接回答尺寸/材料类问题
+        self.spec_index = SpecIndex(self.data_dir()).load()
+        
+    def current_generations(self) -> Dict[str, int]:
+        return {file_key: self.generations.get(file_key) for file_key in ('file1', 'file2')}
+        
+    def data_dir(self) -> str:
+        return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'processed_data')
+        
+    def read_chunks(self, file_key: str):
+        """读取文本块：优先以mmap方式共享读取，旧数据退回到JSON"""
+        data_dir = self.data_dir()
+        if os.path.exists(manifest_path(data_dir, file_key)):
+            texts, _, _, _ = load_embeddings(manifest_path(data_dir, file_key), shared_text=True)
+            return texts
+        text_path = os.path.join(data_dir, f'{file_key}_text.json')
+        if os.path.exists(text_path):
+            with open(text_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return []
         
     def load_document_content(self) -> str:
-        """从处理后的文件中加载文档内容"""
+        """
+        从处理后的文件中加载文档内容。
+        提示词只用到前 DOCUMENT_CONTENT_LIMIT 个字符，读够后即停止，避免每个worker都保存整份文档。
+        """
         content = []
-        data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'processed_data')
+        length = 0
         
-        # 尝试加载文件1的内容
-        try:
-            file1_path = os.path.join(data_dir, 'file1_text.json')
-            if os.path.exists(file1_path):
-                with open(file1_path, 'r', encoding='utf-8') as f:
-                    file1_content = json.load(f)
-                    if file1_content:
-                        content.append("【文档1内容】")
-                        content.extend(file1_content)
-        except Exception as e:
-            print(f"加载文件1内容失败: {e}")
-            
-        # 尝试加载文件2的内容
-        try:
-            file2_path = os.path.join(data_dir, 'file2_text.json')
-            if os.path.exists(file2_path):
-                with open(file2_path, 'r', encoding='utf-8') as f:
-                    file2_content = json.load(f)
-                    if file2_content:
-                        content.append("【文档2内容】")
-                        content.extend(file2_content)
-        except Exception as e:
-            print(f"加载文件2内容失败: {e}")
+        for number, file_key in ((1, 'file1'), (2, 'file2')):
+            try:
+                chunks = self.read_chunks(file_key)
+                if len(chunks) and length <= DOCUMENT_CONTENT_LIMIT:
+                    content.append(f"【文档{number}内容】")
+                    for chunk in chunks:
+                        content.append(chunk)
+                        length += len(chunk) + 2
+                        if length > DOCUMENT_CONTENT_LIMIT:
+                            break
+            except Exception as e:
+                print(f"加载文件{number}内容失败: {e}")
             
         return "\n\n".join(content) if content else ""
         
+    def flight_key(self, message: str):
+        """合并键：规范化后的问题 + 文档版本（各文件的发布代数）"""
+        return (normalize_question(message), tuple(sorted(self.current_generations().items())))
+        
     def handle_message(self, message: str) -> str:
+        """处理用户消息；相同问题的并发请求只计算一次"""
+        return self.flight.do(self.flight_key(message), self._handle_message, message)
+        
+    def _handle_message(self, message: str) -> str:
         """处理用户消息，直接调用DeepSeek API生成回答"""
         try:
+            # 其他进程上传了新文件时重新加载
+            if self.current_generations() != self.loaded_generations:
+                self.reload_document_content()
+            
             if not self.document_content:
                 return "未找到任何文档内容。请先上传PDF文件。"
             
+            # 能从规格索引直接回答的查值/比对问题不调用大模型
+            answer = self.spec_index.answer(message)
+            if answer:
+                return answer
+            
             # 直接调用DeepSeek API生成回答
             response = self.call_deepseek_api(message, self.document_content)
             return response
             
+        except LLMUnavailable:
+            # 交给视图返回 503 和 Retry-After
+            raise
         except Exception as e:
             print(f"处理消息时出错: {str(e)}")
             return f"处理您的请求时发生错误，请稍后再试。"
     
-    def call_deepseek_api(self, query: str, context: str) -> str:
-        """调用DeepSeek API生成回答"""
-        if not self.api_key:
-            return "API密钥未配置，无法调用DeepSeek模型。请配置DEEPSEEK_API_KEY环境变量。"
-            
-        try:
-            # 处理特殊类型的问题，比如关于助手身份的问题
-            if query.lower() in ["你是谁", "你是什么", "你叫什么", "你的身份是什么", "你是哪个模型"]:
-                return """我是一个文档助手，专门用来回答与上传文档相关的问题。我的工作是分析文档内容，提取相关信息，并以清晰、准确的方式回答您的问题。
+    def identity_answer(self, query: str):
+        """关于助手身份的问题直接返回固定回答，否则返回 None"""
+        # 处理特殊类型的问题，比如关于助手身份的问题
+        if query.lower() in ["你是谁", "你是什么", "你叫什么", "你的身份是什么", "你是哪个模型"]:
+            return """我是一个文档助手，专门用来回答与上传文档相关的问题。我的工作是分析文档内容，提取相关信息，并以清晰、准确的方式回答您的问题。
 
 我不是独立的AI，而是一个专门为解读您上传的PDF文档而设计的工具。如果您有任何关于文档内容的问题，请随时提问，我会尽力从文档中找到相关信息来回答您。"""
-                
-            # 构建更强大的系统提示
-            system_prompt = """你是一个专业的PDF文档分析助手。你的主要功能是帮助用户理解他们上传的PDF文档内容。请严格遵循以下原则:
+        return None
+    
+    def build_payload(self, query: str, context: str):
+        """构建DeepSeek API的请求头和请求体（同步和异步调用共用）"""
+        # 构建更强大的系统提示
+        system_prompt = """你是一个专业的PDF文档分析助手。你的主要功能是帮助用户理解他们上传的PDF文档内容。请严格遵循以下原则:
 
 1. 身份意识：当被问到你是谁时，清楚地表明你是"PDF文档助手"，专门用于分析和回答关于用户上传文档的问题。
 2. 内容权威：回答必须严格基于文档内容，不要添加未在文档中明确陈述的信息。
@@ -90,66 +152,136 @@ class MessageHandler:
 
 记住：你是专门用来帮助用户理解他们上传的文档内容的工具。对于文档范围之外的问题，请明确表示这超出了当前文档的范围。"""
 
-            # 构建更好的用户提示 - 减少文档内容长度以避免超出限制
-            doc_excerpt = context[:8000] if len(context) > 8000 else context
-            context_intro = f"""【文档内容摘要】\n\n{doc_excerpt}\n\n【文档内容摘要结束】"""
-            
-            if len(context) > 8000:
-                context_intro += "\n\n(注：由于文档较长，上面仅显示部分内容。)"
-            
-            user_prompt = f"""问题: {query}
+        # 构建更好的用户提示 - 减少文档内容长度以避免超出限制
+        doc_excerpt = context[:8000] if len(context) > 8000 else context
+        context_intro = f"""【文档内容摘要】\n\n{doc_excerpt}\n\n【文档内容摘要结束】"""
+        
+        if len(context) > 8000:
+            context_intro += "\n\n(注：由于文档较长，上面仅显示部分内容。)"
+        
+        user_prompt = f"""问题: {query}
 
 请基于提供的文档内容回答上述问题。记住:
 1. 如果这个问题是关于你自己的，请表明你是一个PDF文档助手，专门用于回答关于上传文档的问题
 2. 如果是关于文档内容的问题，请仅使用文档中的信息回答
 3. 如果文档中没有相关信息，请直接说明
 4. 回答要简洁、准确且有条理"""
+        
+        # 准备API请求
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        payload = {
+            "model": "deepseek-chat",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": context_intro},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": 0.2,  # 降低温度以获得更精确的回答
+            "max_tokens": 2000
+        }
+        return headers, payload
+    
+    @staticmethod
+    def parse_result(result: Dict[str, Any]) -> str:
+        """从DeepSeek API响应中取出回答"""
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        else:
+            return "无法从DeepSeek API获取有效回答。请检查API响应格式是否有变化。"
+    
+    def call_deepseek_api(self, query: str, context: str) -> str:
+        """调用DeepSeek API生成回答"""
+        if not self.api_key:
+            return "API密钥未配置，无法调用DeepSeek模型。请配置DEEPSEEK_API_KEY环境变量。"
             
-            # 准备API请求
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": context_intro},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.2,  # 降低温度以获得更精确的回答
-                "max_tokens": 2000
-            }
+        try:
+            identity = self.identity_answer(query)
+            if identity:
+                return identity
+            
+            headers, payload = self.build_payload(query, context)
             
             # 在请求前添加日志
             print(f"正在向 {self.api_url} 发送请求...")
             
             # 添加SSL验证禁用选项来解决SSL问题（仅用于开发环境）
-            response = requests.post(
-                self.api_url, 
-                headers=headers, 
-                json=payload,
-                verify=False,  # 禁用SSL验证
-                timeout=30  # 增加超时时间
-            )
-            
-            print(f"收到响应状态码: {response.status_code}")
-            response.raise_for_status()  # 检查HTTP错误
+            # 并发已满或熔断打开时抛出 LLMUnavailable；服务端错误和限流计入熔断统计
+            with self.guard.slot():
+                response = requests.post(
+                    self.api_url, 
+                    headers=headers, 
+                    json=payload,
+                    verify=False,  # 禁用SSL验证
+                    timeout=30  # 增加超时时间
+                )
+                
+                print(f"收到响应状态码: {response.status_code}")
+                raise_for_upstream_status(response)
+            response.raise_for_status()  # 其他HTTP错误（如密钥无效）不计入熔断统计
             
             # 解析响应
-            result = response.json()
-            
-            if "choices" in result and len(result["choices"]) > 0:
-                return result["choices"][0]["message"]["content"]
-            else:
-                return "无法从DeepSeek API获取有效回答。请检查API响应格式是否有变化。"
+            return self.parse_result(response.json())
                 
         except requests.exceptions.RequestException as e:
             print(f"调用DeepSeek API时出错: {str(e)}")
             return f"调用DeepSeek API时出错: {str(e)}"
+    
+    async def acall_deepseek_api(self, query: str, context: str) -> str:
+        """call_deepseek_api 的异步版本，等待响应期间不占用线程"""
+        if not self.api_key:
+            return "API密钥未配置，无法调用DeepSeek模型。请配置DEEPSEEK_API_KEY环境变量。"
+            
+        try:
+            identity = self.identity_answer(query)
+            if identity:
+                return identity
+            
+            headers, payload = self.build_payload(query, context)
+            print(f"正在向 {self.api_url} 发送异步请求...")
+            async with self.guard.aslot(), self.async_http.client() as client:
+                response = await client.post(self.api_url, headers=headers, json=payload)
+                print(f"收到响应状态码: {response.status_code}")
+                raise_for_upstream_status(response)
+            response.raise_for_status()
+            return self.parse_result(response.json())
+                
+        except httpx.HTTPError as e:
+            print(f"调用DeepSeek API时出错: {str(e)}")
+            return f"调用DeepSeek API时出错: {str(e)}"
+    
+    async def ahandle_message(self, message: str) -> str:
+        """handle_message 的异步版本；相同问题的并发请求共享同一次计算"""
+        return await self.flight.do_async(self.flight_key(message), self._ahandle_message, message)
+    
+    async def _ahandle_message(self, message: str) -> str:
+        """CPU密集的索引查询放到有界线程池，API调用走异步HTTP"""
+        try:
+            loop = asyncio.get_running_loop()
+            if self.current_generations() != self.loaded_generations:
+                await loop.run_in_executor(CPU_EXECUTOR, self.reload_document_content)
+            
+            if not self.document_content:
+                return "未找到任何文档内容。请先上传PDF文件。"
+            
+            answer = await loop.run_in_executor(CPU_EXECUTOR, self.spec_index.answer, message)
+            if answer:
+                return answer
+            
+            return await self.acall_deepseek_api(message, self.document_content)
+            
+        except LLMUnavailable:
+            raise
+        except Exception as e:
+            print(f"处理消息时出错: {str(e)}")
+            return f"处理您的请求时发生错误，请稍后再试。"
             
     def reload_document_content(self):
         """重新加载文档内容"""
+        self.loaded_generations = self.current_generations()
         self.document_content = self.load_document_content()
+        self.spec_index.load()
         return len(self.document_content) > 0
\ No newline at end of file
@@ -1,3 +1,629 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+
+from .media import _parse_range, serve_media
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'pdfprocessor'))
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
+
+import pdf_text
+from bulk_ingest import IngestProgress, _EmbeddingWorker
+from embedding_store import load_embeddings, manifest_path, save_embeddings
+from ingest_checkpoint import IngestCheckpoint, pending_jobs
+from shared_store import GenerationCounter
+from single_flight import SingleFlight
+from llm_guard import LLMGuard, LLMOverloaded, LLMUnavailable, raise_for_upstream_status
+from page_records import page_hash
+from spec_index import SpecIndex, parse_specs
+from text_index import InvertedIndex, tokenize
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_single_range(self):
+        self.assertEqual(_parse_range('bytes=0-99', 1000), (0, 99))
+
+    def test_open_ended_range(self):
+        self.assertEqual(_parse_range('bytes=900-', 1000), (900, 999))
+
+    def test_end_clamped_to_size(self):
+        self.assertEqual(_parse_range('bytes=900-5000', 1000), (900, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(_parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(_parse_range('bytes=-5000', 1000), (0, 999))
+
+    def test_unsatisfiable(self):
+        self.assertIsNone(_parse_range('bytes=1000-', 1000))
+        self.assertIsNone(_parse_range('bytes=500-100', 1000))
+        self.assertIsNone(_parse_range('bytes=-0', 1000))
+
+    def test_multi_range_and_malformed_return_full(self):
+        self.assertEqual(_parse_range('bytes=0-9,20-29', 1000), 'full')
+        self.assertEqual(_parse_range('items=0-9', 1000), 'full')
+        self.assertEqual(_parse_range('bytes=-', 1000), 'full')
+
+
+class ServeMediaTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.content = bytes(range(256)) * 4
+        with open(os.path.join(self.root, 'doc.pdf'), 'wb') as f:
+            f.write(self.content)
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        request = self.factory.get('/media/doc.pdf', headers=headers)
+        return serve_media(request, 'doc.pdf', document_root=self.root)
+
+    def test_full_response(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_partial_content(self):
+        response = self.get(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+    def test_suffix_range(self):
+        response = self.get(Range='bytes=-16')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[-16:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_multi_range_returns_full_file(self):
+        response = self.get(Range='bytes=0-9,20-29')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(Range='bytes=0-9', **{'If-Range': etag}).status_code, 206)
+        self.assertEqual(self.get(Range='bytes=0-9', **{'If-Range': '"stale"'}).status_code, 200)
+
+    def test_if_none_match(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(**{'If-None-Match': etag}).status_code, 304)
+
+    def consume_async(self, response):
+        async def collect():
+            return b''.join([chunk async for chunk in response.streaming_content])
+        return asyncio.run(collect())
+
+    def test_asgi_streams_full_file_asynchronously(self):
+        request = AsyncRequestFactory().get('/media/doc.pdf')
+        response = serve_media(request, 'doc.pdf', document_root=self.root)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(self.consume_async(response), self.content)
+
+    def test_asgi_streams_range_asynchronously(self):
+        request = AsyncRequestFactory().get('/media/doc.pdf', headers={'Range': 'bytes=100-299'})
+        response = serve_media(request, 'doc.pdf', document_root=self.root)
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        self.assertEqual(self.consume_async(response), self.content[100:300])
+
+    @override_settings(MEDIA_SENDFILE_BACKEND='x-accel-redirect')
+    def test_accel_redirect_uses_route_prefix(self):
+        request = self.factory.get('/media/doc.pdf')
+        response = serve_media(request, 'doc.pdf', document_root=self.root, accel_prefix='/protected/media/')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/media/doc.pdf')
+
+    @override_settings(MEDIA_SENDFILE_BACKEND='x-accel-redirect')
+    def test_accel_redirect_percent_encodes_non_ascii_names(self):
+        shutil.copy(os.path.join(self.root, 'doc.pdf'), os.path.join(self.root, '装配图 A1.pdf'))
+        request = self.factory.get('/media/装配图 A1.pdf')
+        response = serve_media(request, '装配图 A1.pdf', document_root=self.root, accel_prefix='/protected/media/')
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/media/%E8%A3%85%E9%85%8D%E5%9B%BE%20A1.pdf')
+
+    @override_settings(MEDIA_SENDFILE_BACKEND='x-sendfile')
+    def test_sendfile_percent_encodes_non_ascii_names(self):
+        shutil.copy(os.path.join(self.root, 'doc.pdf'), os.path.join(self.root, '装配图.pdf'))
+        response = serve_media(self.factory.get('/media/x'), '装配图.pdf', document_root=self.root)
+        header = response['X-Sendfile']
+        self.assertTrue(header.isascii())
+        self.assertTrue(header.endswith('/%E8%A3%85%E9%85%8D%E5%9B%BE.pdf'))
+
+
+class SpecIndexAnswerTests(SimpleTestCase):
+    def setUp(self):
+        self.index = SpecIndex(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.index.data_dir)
+        self.index.add_entries('file1', parse_specs('执行标准 GB/T 1234-2008，壳体材料Q345B，轴径 Φ50mm ±0.1', 3))
+        self.index.add_entries('file2', parse_specs('执行标准 GB/T 9999-2010，壳体材料Q345B，轴径 Φ50.5mm ±0.1', 3))
+
+    def test_explanation_questions_fall_through(self):
+        self.assertIsNone(self.index.answer('为什么选用这个标准？请解释设计理由'))
+        self.assertIsNone(self.index.answer('总结一下壳体材料的要求'))
+
+    def test_questions_without_value_or_compare_intent_fall_through(self):
+        self.assertIsNone(self.index.answer('轴径'))
+
+    def test_value_question_lists_values_without_comparison(self):
+        answer = self.index.answer('轴径是多少？')
+        self.assertIn('Φ50mm ±0.1', answer)
+        self.assertNotIn('超差', answer)
+
+    def test_compare_question_reports_differences(self):
+        self.assertIn('尺寸误差', self.index.answer('轴径是否合规？'))
+
+    def test_standard_differences_have_their_own_error_type(self):
+        error_types = {diff['error_type'] for diff in self.index.compare('标准')}
+        self.assertEqual(error_types, {'标准不符'})
+
+
+class LLMGuardTests(SimpleTestCase):
+    def fail_call(self, guard):
+        with self.assertRaises(RuntimeError):
+            with guard.slot():
+                raise RuntimeError('upstream error')
+
+    def call_with_status(self, guard, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = 'https://api.deepseek.com/v1/chat/completions'
+        try:
+            with guard.slot():
+                raise_for_upstream_status(response)
+        except requests.HTTPError:
+            pass
+
+    def test_only_upstream_failures_count_toward_circuit(self):
+        guard = LLMGuard(window=4, min_calls=2, failure_ratio=0.5)
+        self.call_with_status(guard, 401)
+        self.call_with_status(guard, 400)
+        self.assertEqual(list(guard._outcomes), [True, True])
+        self.call_with_status(guard, 429)
+        self.call_with_status(guard, 503)
+        self.assertEqual(guard._state, 'open')
+
+    def test_rejects_when_queue_full(self):
+        guard = LLMGuard(max_concurrent=1, max_queue=0)
+        with guard.slot():
+            with self.assertRaises(LLMOverloaded):
+                with guard.slot():
+                    pass
+        self.assertEqual(guard._active, 0)
+
+    def test_queue_timeout(self):
+        guard = LLMGuard(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+        with guard.slot():
+            with self.assertRaises(LLMOverloaded):
+                with guard.slot():
+                    pass
+            self.assertEqual(len(guard._waiters), 0)
+        self.assertEqual(guard._active, 0)
+
+    def test_circuit_opens_half_opens_and_closes(self):
+        guard = LLMGuard(window=4, min_calls=2, failure_ratio=0.5, open_seconds=0.05)
+        self.fail_call(guard)
+        self.fail_call(guard)
+        self.assertEqual(guard._state, 'open')
+        with self.assertRaises(LLMUnavailable) as cm:
+            with guard.slot():
+                pass
+        self.assertNotIsInstance(cm.exception, LLMOverloaded)
+
+        time.sleep(0.06)
+        with guard.slot():
+            # 半开状态只放行一个探测请求
+            self.assertEqual(guard._state, 'half_open')
+            with self.assertRaises(LLMUnavailable):
+                with guard.slot():
+                    pass
+        self.assertEqual(guard._state, 'closed')
+
+    def test_failed_probe_reopens_circuit(self):
+        guard = LLMGuard(window=4, min_calls=2, failure_ratio=0.5, open_seconds=0.05)
+        self.fail_call(guard)
+        self.fail_call(guard)
+        time.sleep(0.06)
+        self.fail_call(guard)
+        self.assertEqual(guard._state, 'open')
+        self.assertFalse(guard._probe_in_flight)
+
+    def test_cancelled_waiter_leaves_queue(self):
+        guard = LLMGuard(max_concurrent=1, max_queue=4)
+
+        async def wait_for_slot():
+            async with guard.aslot():
+                pass
+
+        async def main():
+            async with guard.aslot():
+                waiter = asyncio.ensure_future(wait_for_slot())
+                await asyncio.sleep(0.01)
+                self.assertEqual(len(guard._waiters), 1)
+                waiter.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await waiter
+                self.assertEqual(len(guard._waiters), 0)
+
+        asyncio.run(main())
+        self.assertEqual(guard._active, 0)
+
+    def test_cancelled_waiter_returns_granted_slot(self):
+        guard = LLMGuard(max_concurrent=1, max_queue=4)
+
+        async def wait_for_slot():
+            async with guard.aslot():
+                pass
+
+        async def main():
+            async with guard.aslot():
+                waiter = asyncio.ensure_future(wait_for_slot())
+                await asyncio.sleep(0.01)
+            # 名额已交给等待者，但它在被唤醒前就被取消了
+            self.assertEqual(guard._active, 1)
+            self.assertEqual(len(guard._waiters), 0)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+
+        asyncio.run(main())
+        self.assertEqual(guard._active, 0)
+
+
+def write_pdf(path, pages):
+    """写一个测试PDF：pages 中每项是一页的内容流文本列表，/Contents 为流数组"""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    }))
+    for streams in pages:
+        writer.add_blank_page(200, 200)
+        page = writer.pages[-1]
+        refs = []
+        for data in streams:
+            stream = DecodedStreamObject()
+            stream.set_data(data.encode('latin-1'))
+            refs.append(writer._add_object(stream))
+        page[NameObject('/Contents')] = ArrayObject(refs)
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/Font'): DictionaryObject({NameObject('/F1'): font}),
+        })
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+def text_streams(text):
+    return ['BT /F1 12 Tf 10 100 Td', f'({text}) Tj ET']
+
+
+class PageRecordTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def pdf(self, name, texts):
+        path = os.path.join(self.dir, name)
+        write_pdf(path, [text_streams(text) for text in texts])
+        return path
+
+    def test_multi_stream_pages(self):
+        pages = pdf_text.extract_pages(self.pdf('a.pdf', ['alpha', 'beta', 'alpha']))
+        self.assertEqual([page['text'].strip() for page in pages], ['alpha', 'beta', 'alpha'])
+        self.assertNotEqual(pages[0]['hash'], pages[1]['hash'])
+        self.assertEqual(pages[0]['hash'], pages[2]['hash'])
+
+    def test_unchanged_pages_reuse_previous_records(self):
+        previous = pdf_text.extract_pages(self.pdf('v1.pdf', ['alpha', 'beta']))
+        previous[1] = dict(previous[1], text='cached beta', specs=[{'label': 'x'}])
+        # 修订版：在前面插入一页，beta 页移动到第3页，alpha 页内容改变
+        pages = pdf_text.extract_pages(self.pdf('v2.pdf', ['new', 'alpha2', 'beta']), previous)
+        self.assertEqual(pages[2]['text'], 'cached beta')
+        self.assertEqual(pages[2]['specs'], [{'label': 'x'}])
+        self.assertEqual(pages[1]['text'].strip(), 'alpha2')
+        self.assertIsNone(pages[1]['specs'])
+
+    def test_hash_failure_falls_back_to_text_hash(self):
+        path = self.pdf('a.pdf', ['alpha'])
+        with mock.patch.object(pdf_text, 'page_hash', side_effect=ValueError('bad page')):
+            pages = pdf_text.extract_pages(path)
+        self.assertEqual(pages[0]['text'].strip(), 'alpha')
+        self.assertTrue(pages[0]['hash'].startswith('text:'))
+
+    def test_page_hash_covers_every_content_stream(self):
+        path = os.path.join(self.dir, 'b.pdf')
+        write_pdf(path, [['BT /F1 12 Tf', '(one) Tj ET'], ['BT /F1 12 Tf', '(two) Tj ET']])
+        reader = PdfReader(path)
+        self.assertNotEqual(page_hash(reader.pages[0]), page_hash(reader.pages[1]))
+
+
+class FakeModel:
+    def encode(self, texts, **kwargs):
+        if any('bad' in text for text in texts):
+            raise ValueError('bad chunk')
+        return [[1.0, 0.0] for _ in texts]
+
+
+class EmbeddingWorkerTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.progress = IngestProgress(3, stream=open(os.devnull, 'w'))
+        self.addCleanup(self.progress.stream.close)
+
+    def document(self, key, text):
+        return {'path': f'{key}.pdf', 'key': key, 'pages': 1,
+                'chunks': [{'text': text, 'page_start': 1, 'page_end': 1}]}
+
+    def run_worker(self, documents):
+        worker = _EmbeddingWorker(FakeModel(), 'fake', self.dir, self.progress, batch_size=16, max_pending=8)
+        worker.start()
+        for document in documents:
+            worker.submit(document)
+        worker.close()
+
+    def test_failed_document_does_not_stop_the_run(self):
+        self.run_worker([self.document('doc_a', 'good a'), self.document('doc_b', 'bad b'),
+                         self.document('doc_c', 'good c')])
+        self.assertEqual((self.progress.ingested, self.progress.failed), (2, 1))
+        self.assertTrue(os.path.exists(manifest_path(self.dir, 'doc_a')))
+        self.assertTrue(os.path.exists(manifest_path(self.dir, 'doc_c')))
+        self.assertFalse(os.path.exists(manifest_path(self.dir, 'doc_b')))
+
+    def test_save_error_counts_document_as_failed(self):
+        with mock.patch('bulk_ingest.save_embeddings', side_effect=[OSError('disk'), None]):
+            self.run_worker([self.document('doc_a', 'good a'), self.document('doc_b', 'good b')])
+        self.assertEqual((self.progress.ingested, self.progress.failed), (1, 1))
+
+
+class EmbeddingStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def publish(self, texts):
+        vectors = [[float(i), 1.0] for i in range(len(texts))]
+        return save_embeddings(self.dir, 'file1', texts, vectors, [{} for _ in texts], 'fake')
+
+    def data_files(self):
+        return {name for name in os.listdir(self.dir)
+                if name.startswith('file1_') and name != 'file1_manifest.json'}
+
+    def test_each_publish_writes_new_files(self):
+        first = self.publish(['旧文本一', '旧文本二'])
+        second = self.publish(['新文本一', '新文本二'])
+        for key in ('text_file', 'meta_file', 'vectors_file', 'text_blob_file', 'text_offsets_file'):
+            self.assertNotEqual(first[key], second[key])
+        texts, _, _, _ = load_embeddings(manifest_path(self.dir, 'file1'), shared_text=True)
+        self.assertEqual(list(texts), ['新文本一', '新文本二'])
+
+    def test_previous_publish_is_kept_and_older_ones_removed(self):
+        first = self.publish(['a'])
+        second = self.publish(['b'])
+        # 刚读到旧清单的进程仍能打开上一次发布的文件
+        self.assertTrue(os.path.exists(os.path.join(self.dir, first['text_blob_file'])))
+        third = self.publish(['c'])
+        files = {third[key] for key in third if key.endswith('_file')}
+        files |= {second[key] for key in second if key.endswith('_file')}
+        self.assertEqual(self.data_files(), files)
+
+
+class PendingJobsTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def upload(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return IngestCheckpoint(self.dir, 'file1', path)
+
+    def test_interrupted_upload_is_resumed(self):
+        checkpoint = self.upload('a.pdf', b'A')
+        self.assertEqual(pending_jobs(self.dir), [('file1', checkpoint.pdf_path)])
+
+    def test_job_superseded_by_published_upload_is_dropped(self):
+        stale = self.upload('a.pdf', b'A')
+        self.upload('b.pdf', b'B').clear()
+        GenerationCounter(self.dir).bump('file1')
+        self.assertEqual(pending_jobs(self.dir), [])
+        self.assertFalse(os.path.exists(stale.dir))
+
+    def test_only_newest_crashed_upload_per_slot_is_resumed(self):
+        # 摘要排序与开始顺序相反，确认按开始时间而不是目录名选择
+        older = self.upload('z.pdf', b'older')
+        newer = self.upload('y.pdf', b'newer')
+        self.assertEqual(pending_jobs(self.dir), [('file1', newer.pdf_path)])
+        self.assertFalse(os.path.exists(older.dir))
+
+
+class TextIndexTests(SimpleTestCase):
+    texts = [
+        '法兰螺栓 GB/T5782 M12 数量 8',
+        '密封垫片材质 Q345B，厚度 3mm',
+        '螺栓预紧力矩见图号 A-102.3',
+        '检修周期 12 个月',
+        '螺栓 M12 与 M16 不可互换',
+    ]
+
+    def build(self):
+        index = InvertedIndex()
+        index.add(self.texts[:3])
+        index.add(self.texts[3:])
+        return index
+
+    def test_tokenize_cjk_bigrams_and_part_numbers(self):
+        self.assertEqual(tokenize('螺栓'), ['螺栓'])
+        self.assertEqual(tokenize('法兰盘'), ['法兰', '兰盘'])
+        self.assertEqual(tokenize('阀'), ['阀'])
+        self.assertEqual(tokenize('GB/T5782'), ['gb/t5782', 'gb', 't5782'])
+        self.assertEqual(tokenize('A-102.3'), ['a-102.3', 'a', '102', '3'])
+        self.assertEqual(tokenize('Q345B'), ['q345b'])
+
+    def test_search_ranks_matching_documents_across_segments(self):
+        results = self.build().search('螺栓 M12', top_k=10)
+        self.assertEqual({doc_id for doc_id, _ in results}, {0, 2, 4})
+        self.assertEqual(results, sorted(results, key=lambda item: -item[1]))
+        self.assertEqual(self.build().search('不存在的词'), [])
+
+    def test_candidates_restrict_results_without_changing_scores(self):
+        index = self.build()
+        full = dict(index.search('螺栓 M12', top_k=10))
+        pruned = index.search('螺栓 M12', top_k=10, candidates=[4, 2, 3, 4])
+        self.assertEqual({doc_id for doc_id, _ in pruned}, {2, 4})
+        for doc_id, score in pruned:
+            self.assertAlmostEqual(score, full[doc_id], places=5)
+        self.assertEqual(index.search('螺栓', candidates=[]), [])
+        self.assertEqual(index.search('螺栓', candidates=[1, 3]), [])
+
+    def test_save_load_round_trip(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        index = self.build()
+        index.save(index_dir)
+        loaded = InvertedIndex.load(index_dir)
+        self.assertEqual(len(loaded), len(self.texts))
+        for query in ('螺栓 M12', 'GB/T5782', 'q345b 厚度', '检修'):
+            self.assertEqual(loaded.search(query), index.search(query))
+
+        # 追加段后再次保存：已落盘的段不重写，读取结果包含新段
+        names = [segment['name'] for segment in loaded.segments]
+        loaded.add(['螺栓防松措施'])
+        loaded.save(index_dir)
+        reloaded = InvertedIndex.load(index_dir)
+        self.assertEqual([segment['name'] for segment in reloaded.segments][:2], names)
+        self.assertIn(5, {doc_id for doc_id, _ in reloaded.search('螺栓')})
+        self.assertEqual(InvertedIndex.load(os.path.join(index_dir, 'missing')).segments, [])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def compute(self, value='answer'):
+        self.calls += 1
+        self.release.wait(5)
+        return value
+
+    async def acompute(self, value='answer'):
+        self.calls += 1
+        while not self.release.is_set():
+            await asyncio.sleep(0.005)
+        return value
+
+    def wait_for_leader(self):
+        deadline = time.monotonic() + 5
+        while not self.calls and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def start(self, target, results):
+        def run():
+            try:
+                results.append(target())
+            except BaseException as e:
+                results.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_sync_followers_share_one_call(self):
+        results = []
+        threads = [self.start(lambda: self.flight.do('q', self.compute), results)]
+        self.wait_for_leader()
+        threads += [self.start(lambda: self.flight.do('q', self.compute), results) for _ in range(3)]
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ['answer'] * 4)
+        self.assertEqual(self.flight._calls, {})
+
+    def test_error_is_shared_and_not_cached(self):
+        def fail():
+            self.calls += 1
+            self.release.wait(5)
+            raise ValueError('upstream')
+
+        results = []
+        threads = [self.start(lambda: self.flight.do('q', fail), results)]
+        self.wait_for_leader()
+        threads.append(self.start(lambda: self.flight.do('q', fail), results))
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([type(result) for result in results], [ValueError, ValueError])
+        self.assertEqual(self.flight.do('q', self.compute, 'again'), 'again')
+
+    def test_async_and_sync_followers_across_loops(self):
+        results = []
+        threads = [self.start(lambda: asyncio.run(self.flight.do_async('q', self.acompute)), results)]
+        self.wait_for_leader()
+        # 另一个线程中的另一个事件循环，以及一个同步调用
+        threads.append(self.start(lambda: asyncio.run(self.flight.do_async('q', self.acompute, 'other')), results))
+        threads.append(self.start(lambda: self.flight.do('q', self.compute, 'other'), results))
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ['answer'] * 3)
+
+    def test_cancelled_waiters_do_not_cancel_computation(self):
+        async def main():
+            leader = asyncio.ensure_future(self.flight.do_async('q', self.acompute))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(self.flight.do_async('q', self.acompute))
+            cancelled = asyncio.ensure_future(self.flight.do_async('q', self.acompute))
+            await asyncio.sleep(0.01)
+            # 跟随者和领头者的请求都被取消（客户端断开），计算继续，剩下的等待者拿到结果
+            cancelled.cancel()
+            leader.cancel()
+            await asyncio.sleep(0.01)
+            self.release.set()
+            return await follower, leader.cancelled(), cancelled.cancelled()
+
+        self.assertEqual(asyncio.run(main()), ('answer', True, True))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flight._calls, {})
+        self.assertEqual(self.flight._tasks, set())
+
+    def test_closed_leader_loop_cancels_followers(self):
+        async def abandon():
+            # 领头者的事件循环在计算完成前结束，asyncio.run 退出时取消计算任务
+            try:
+                await asyncio.wait_for(self.flight.do_async('q', self.acompute), 0.2)
+            except asyncio.TimeoutError:
+                return 'abandoned'
+
+        leader_results, follower_results = [], []
+        leader = self.start(lambda: asyncio.run(abandon()), leader_results)
+        self.wait_for_leader()
+        follower = self.start(lambda: self.flight.do('q', self.compute), follower_results)
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(leader_results, ['abandoned'])
+        self.assertEqual(len(follower_results), 1)
+        self.assertIsInstance(follower_results[0], asyncio.CancelledError)
+        self.assertEqual(self.flight._calls, {})
+        self.release.set()
+        self.assertEqual(self.flight.do('q', self.compute, 'again'), 'again')
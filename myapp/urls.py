@@ -5,4 +5,7 @@ urlpatterns = [
     path('', views.index, name='index'),
     # path('upload/', views.upload_file, name='upload_file'),
     path('api/message/', views.handle_message, name='handle_message'),
+    path('api/pages/<str:doc_hash>/', views.page_info, name='page_info'),
+    path('api/pages/<str:doc_hash>/<int:page>/thumb.png', views.page_thumbnail, name='page_thumbnail'),
+    path('api/pages/<str:doc_hash>/<int:page>/tiles/<int:zoom>/<int:x>_<int:y>.png', views.page_tile, name='page_tile'),
 ]
\ No newline at end of file
@@ -1,21 +1,51 @@
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
 from django.shortcuts import render
 from django.core.files.storage import FileSystemStorage
-from django.http import HttpRequest, JsonResponse
+from django.conf import settings
+from django.http import Http404, HttpRequest, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+import functools
 import json
+import math
 import os
 import sys
 
 # 添加PDF处理器到系统路径
 sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'pdfprocessor'))
 from pdf_processor import PDFBatchProcessor
-from .message_handler import MessageHandler
+from page_cache import PageRenderCache
+from .media import serve_media
+from .message_handler import LLMUnavailable, MessageHandler
 
 ALLOWED_EXTENSIONS = {'.pdf'}
+# 页面缓存在 Nginx 中对应的 internal location
+PAGE_CACHE_ACCEL_PREFIX = f'{settings.MEDIA_ACCEL_REDIRECT_PREFIX}page_cache/'
 pdf_processor = PDFBatchProcessor()
 message_handler = MessageHandler()
+page_cache = PageRenderCache(
+    settings.PAGE_CACHE_DIR,
+    max_bytes=settings.PAGE_CACHE_MAX_BYTES,
+    max_workers=settings.PAGE_RENDER_WORKERS,
+)
 
+# 耗时的同步视图（上传后入库、按需渲染页面）使用的线程池
+BLOCKING_VIEW_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='blocking-view')
+
+def off_request_thread(view):
+    """
+    把耗时的同步视图包装为异步视图，在 BLOCKING_VIEW_EXECUTOR 中执行。
+    ASGI下同步视图都在同一个线程中串行执行，一次几分钟的上传入库会卡住所有预览请求。
+    """
+    run = sync_to_async(view, thread_sensitive=False, executor=BLOCKING_VIEW_EXECUTOR)
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run(request, *args, **kwargs)
+    return wrapper
+
+@off_request_thread
 def index(request: HttpRequest):
     if request.method == 'POST':
         # 检查是否是AJAX请求
@@ -49,10 +79,15 @@ def index(request: HttpRequest):
 
                         # 立即处理并保存结果
                         processing_result = pdf_processor.process_uploaded_file(field, file_path)
+                        # 后台预渲染缩略图和瓦片
+                        doc_hash = page_cache.prerender(file_path)
+                        # 让聊天使用最新的文档内容和规格索引
+                        message_handler.reload_document_content()
                             
                         response_data[f"{field}_url"] = pdfjs_url
                         response_data[f"{field}_full_url"] = full_url
                         response_data[f"{field}_processed"] = processing_result
+                        response_data[f"{field}_doc_hash"] = doc_hash
                     except Exception as e:
                         error_message = f"文件上传失败: {str(e)}"
                         break
@@ -88,10 +123,13 @@ def index(request: HttpRequest):
                         
                         # 立即处理PDF文件
                         processing_result = pdf_processor.process_uploaded_file(field, file_path)
+                        doc_hash = page_cache.prerender(file_path)
+                        message_handler.reload_document_content()
 
                         context[f"{field}_url"] = pdfjs_url
                         context[f"{field}_full_url"] = full_url
                         context[f"{field}_processed"] = processing_result
+                        context[f"{field}_doc_hash"] = doc_hash
                     except Exception as e:
                         context['error_message'] = f"文件上传失败: {str(e)}"
 
@@ -101,7 +139,8 @@ def index(request: HttpRequest):
 
 @csrf_exempt
 @require_POST
-def handle_message(request):
+async def handle_message(request):
+    # 异步视图：在ASGI下等待DeepSeek响应时不占用线程
     try:
         data = json.loads(request.body)
         message = data.get('message', '')
@@ -110,10 +149,58 @@ def handle_message(request):
             return JsonResponse({'error': '消息不能为空'}, status=400)
         
         # 使用MessageHandler处理消息
-        response = message_handler.handle_message(message)
+        response = await message_handler.ahandle_message(message)
         
         return JsonResponse({'response': response})
     except json.JSONDecodeError:
         return JsonResponse({'error': '无效的JSON格式'}, status=400)
+    except LLMUnavailable as e:
+        # 大模型并发已满或熔断打开：快速失败，告知客户端何时重试
+        retry_after = max(1, math.ceil(e.retry_after))
+        response = JsonResponse({'error': str(e), 'retry_after': retry_after}, status=503)
+        response['Retry-After'] = str(retry_after)
+        return response
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=500)
+
+def page_info(request, doc_hash):
+    """返回文档页数、页面尺寸和瓦片参数，供前端构建页面导航"""
+    meta = page_cache.load_meta(doc_hash)
+    if meta is None:
+        return JsonResponse({'error': '文档不存在'}, status=404)
+    return JsonResponse({
+        'page_count': meta['page_count'],
+        'page_sizes': meta['page_sizes'],
+        'thumb_width': meta['thumb_width'],
+        'tile_size': meta['tile_size'],
+    })
+
+def render_busy_response():
+    """按需渲染超时：渲染仍在后台进行，让前端稍后重试"""
+    response = JsonResponse({'error': '页面正在渲染，请稍后重试'}, status=503)
+    response['Retry-After'] = '2'
+    return response
+
+@off_request_thread
+def page_thumbnail(request, doc_hash, page):
+    """返回页面缩略图，缓存未命中时按需渲染"""
+    try:
+        rel_path = page_cache.thumbnail_path(doc_hash, page)
+    except TimeoutError:
+        return render_busy_response()
+    if rel_path is None:
+        raise Http404('页面不存在')
+    return serve_media(request, rel_path, document_root=page_cache.cache_dir, accel_prefix=PAGE_CACHE_ACCEL_PREFIX)
+
+@off_request_thread
+def page_tile(request, doc_hash, page, zoom, x, y):
+    """返回指定缩放级别下的页面瓦片，缓存未命中时按需渲染"""
+    if zoom not in settings.PAGE_TILE_ZOOMS:
+        raise Http404('不支持的缩放级别')
+    try:
+        rel_path = page_cache.tile_path(doc_hash, page, zoom, x, y)
+    except TimeoutError:
+        return render_busy_response()
+    if rel_path is None:
+        raise Http404('瓦片不存在')
+    return serve_media(request, rel_path, document_root=page_cache.cache_dir, accel_prefix=PAGE_CACHE_ACCEL_PREFIX)
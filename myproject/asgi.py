@@ -13,4 +13,20 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """Django 不处理 lifespan 事件，这里在进程退出时关闭共享的异步HTTP客户端"""
+    if scope['type'] != 'lifespan':
+        await django_application(scope, receive, send)
+        return
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            from myapp.message_handler import close_async_clients
+            await close_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
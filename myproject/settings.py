@@ -118,6 +118,20 @@ USE_TZ = True
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# 媒体文件发送设置
+# 生产环境可设置为 'x-sendfile'（Apache）或 'x-accel-redirect'（Nginx），由前端服务器直接发送文件
+MEDIA_SENDFILE_BACKEND = None
+# X-Accel-Redirect 使用的 Nginx internal location 前缀；
+# uploads、media 和页面缓存分别使用其下的 uploads/、media/、page_cache/ 子路径，需各自配置一个 location
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected/'
+MEDIA_CACHE_CONTROL = 'private, max-age=3600'
+
+# 页面缩略图/瓦片缓存设置
+PAGE_CACHE_DIR = BASE_DIR / 'page_cache'
+PAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2GB
+PAGE_RENDER_WORKERS = None  # 默认使用 CPU核数-1 个进程
+PAGE_TILE_ZOOMS = (1, 2, 4)
+
 # 文件上传设置
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
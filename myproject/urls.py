@@ -1,18 +1,20 @@
 from django.contrib import admin
 from django.urls import path, include, re_path
-from django.views.static import serve
 import os
 from django.conf import settings
+from myapp.media import serve_media
 
 urlpatterns = [
     path('', include('myapp.urls')),
     path('admin/', admin.site.urls),
     # 只保留 uploads 的文件服务
-    re_path(r'^uploads/(?P<path>.*)$', serve, {
-        'document_root': os.path.join(settings.BASE_DIR, 'uploads')
+    re_path(r'^uploads/(?P<path>.*)$', serve_media, {
+        'document_root': os.path.join(settings.BASE_DIR, 'uploads'),
+        'accel_prefix': f'{settings.MEDIA_ACCEL_REDIRECT_PREFIX}uploads/',
     }),
-    # 添加 media 文件服务
-    re_path(r'^media/(?P<path>.*)$', serve, {
-        'document_root': os.path.join(settings.BASE_DIR, 'media')
+    # 添加 media 文件服务（支持 Range / ETag，供 PDF.js 分段加载）
+    re_path(r'^media/(?P<path>.*)$', serve_media, {
+        'document_root': os.path.join(settings.BASE_DIR, 'media'),
+        'accel_prefix': f'{settings.MEDIA_ACCEL_REDIRECT_PREFIX}media/',
     }),
 ]
\ No newline at end of file
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import weakref
+from contextlib import asynccontextmanager
+
+import httpx
+
+# 所有实例，ASGI进程退出时统一关闭（见 close_async_clients）
+_instances = weakref.WeakSet()
+
+
+class LoopLocalClient:
+    """
+    异步HTTP客户端的统一获取方式（MessageHandler 和知识库共用）：
+    - 常驻事件循环（ASGI部署，整个进程只有一个循环）：同一个循环第二次使用时创建共享的
+      httpx.AsyncClient，之后的调用复用其连接池；
+    - 每个请求新建事件循环（WSGI/开发服务器中的异步视图）：每次调用使用短生命周期的客户端，
+      返回前关闭，不会为每个请求遗留一个未关闭的连接池。
+    事件循环更换时关闭旧循环上的共享客户端。
+    """
+
+    def __init__(self, **client_kwargs):
+        self.client_kwargs = client_kwargs
+        self._lock = threading.Lock()
+        self._last_loop = None
+        self._client = None
+        self._client_loop = None
+        _instances.add(self)
+
+    @asynccontextmanager
+    async def client(self):
+        shared = self._shared_client(asyncio.get_running_loop())
+        if shared is not None:
+            yield shared
+            return
+        async with httpx.AsyncClient(**self.client_kwargs) as client:
+            yield client
+
+    def _shared_client(self, loop):
+        """返回当前循环上的共享客户端；循环第一次出现时返回 None（使用短生命周期客户端）"""
+        stale = None
+        with self._lock:
+            if self._client is not None and self._client_loop is loop:
+                return self._client
+            if self._client is not None:
+                stale = (self._client, self._client_loop)
+                self._client = self._client_loop = None
+            last_loop = self._last_loop() if self._last_loop is not None else None
+            self._last_loop = weakref.ref(loop)
+            if last_loop is loop:
+                self._client = httpx.AsyncClient(**self.client_kwargs)
+                self._client_loop = loop
+            client = self._client
+        if stale is not None:
+            self._close_on_loop(*stale)
+        return client
+
+    @staticmethod
+    def _close_on_loop(client, loop):
+        """在客户端所属的循环上关闭它；该循环已停止时其连接随循环一起释放，无法再关闭"""
+        if loop.is_closed() or not loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        except RuntimeError:
+            pass
+
+    async def aclose(self):
+        """关闭共享客户端（在其所属的事件循环中调用）"""
+        with self._lock:
+            client, loop = self._client, self._client_loop
+            self._client = self._client_loop = None
+        if client is None:
+            return
+        if loop is asyncio.get_running_loop():
+            await client.aclose()
+        else:
+            self._close_on_loop(client, loop)
+
+
+async def close_async_clients():
+    """关闭本进程中所有共享的异步HTTP客户端，供ASGI应用退出时调用"""
+    for instance in list(_instances):
+        await instance.aclose()
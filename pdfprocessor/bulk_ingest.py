@@ -0,0 +1,269 @@
+import os
+import sys
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+try:
+    from .embedding_store import EMBEDDING_MODEL, manifest_path, save_embeddings
+    from .page_cache import file_hash
+    from .pdf_text import chunk_page_texts, extract_pages
+except ImportError:
+    from embedding_store import EMBEDDING_MODEL, manifest_path, save_embeddings
+    from page_cache import file_hash
+    from pdf_text import chunk_page_texts, extract_pages
+
+# 每次送入模型的文本块数（跨文档拼批）
+EMBED_BATCH_SIZE = 256
+# 批量入库的文档以内容哈希命名：doc_<哈希前16位>
+DOCUMENT_KEY_PREFIX = 'doc_'
+
+
+def document_key(digest):
+    return f'{DOCUMENT_KEY_PREFIX}{digest[:16]}'
+
+
+def find_pdfs(root):
+    """按稳定顺序列出目录树中的全部PDF"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.pdf'):
+                paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
+def _extract_document(path, data_dir, chars_per_chunk):
+    """在进程池中执行：计算文件哈希，已入库的直接跳过，否则提取文本并分块"""
+    key = document_key(file_hash(path))
+    if os.path.exists(manifest_path(data_dir, key)):
+        return {'path': path, 'key': key, 'skipped': True}
+    pages = extract_pages(path)
+    chunks = chunk_page_texts([page['text'] for page in pages], chars_per_chunk)
+    return {'path': path, 'key': key, 'skipped': False, 'pages': len(pages), 'chunks': chunks}
+
+
+class IngestProgress:
+    """批量入库的计数、吞吐量和预计剩余时间（提取进程和向量化线程同时更新）"""
+
+    def __init__(self, total, stream=None):
+        self.total = total
+        self.stream = stream or sys.stdout
+        self.started = time.monotonic()
+        self.ingested = 0
+        self.skipped = 0
+        self.failed = 0
+        self.pages = 0
+        self.chunks = 0
+        self._lock = threading.Lock()
+        self._last_report = 0.0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @staticmethod
+    def _format_seconds(seconds):
+        seconds = int(seconds)
+        return f'{seconds // 3600:d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+    def report(self, force=False):
+        """每秒最多刷新一次进度行"""
+        now = time.monotonic()
+        if not force and now - self._last_report < 1.0:
+            return
+        self._last_report = now
+        with self._lock:
+            elapsed = max(now - self.started, 1e-6)
+            finished = self.ingested + self.skipped + self.failed
+            eta = '--:--:--'
+            if finished:
+                eta = self._format_seconds((self.total - finished) * elapsed / finished)
+            line = (f'{finished}/{self.total} 个文件 | 新入库 {self.ingested} 跳过 {self.skipped} 失败 {self.failed} | '
+                    f'{self.ingested / elapsed:.2f} 文件/秒 {self.pages / elapsed:.1f} 页/秒 '
+                    f'{self.chunks / elapsed:.1f} 块/秒 | 已用 {self._format_seconds(elapsed)} 预计剩余 {eta}')
+        self.stream.write('\r' + line)
+        if force:
+            self.stream.write('\n')
+        self.stream.flush()
+
+    def summary(self):
+        return {
+            'total': self.total,
+            'ingested': self.ingested,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'pages': self.pages,
+            'chunks': self.chunks,
+            'seconds': round(time.monotonic() - self.started, 1),
+        }
+
+
+class _EmbeddingWorker(threading.Thread):
+    """
+    专用向量化线程：从有界队列取出已分块的文档，跨文档拼成大批次送入模型，
+    每个文档的向量算完后立即按统一格式发布到共享存储。
+    """
+
+    def __init__(self, model, model_name, data_dir, progress, batch_size, max_pending):
+        super().__init__(name='embedding', daemon=True)
+        self.model = model
+        self.model_name = model_name
+        self.data_dir = data_dir
+        self.progress = progress
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+    def submit(self, document):
+        """队列满时阻塞等待（反压提取进程），向量化线程出错时抛出其异常"""
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(document, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        # 单个文档的错误在 _embed 中处理；这里只捕获线程本身无法继续的异常
+        try:
+            finished = False
+            while not finished:
+                document = self.queue.get()
+                if document is None:
+                    break
+                documents = [document]
+                size = len(document['chunks'])
+                while size < self.batch_size:
+                    try:
+                        document = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if document is None:
+                        finished = True
+                        break
+                    documents.append(document)
+                    size += len(document['chunks'])
+                self._embed(documents)
+        except Exception as e:
+            self.error = e
+
+    def _encode(self, texts):
+        vectors = self.model.encode(texts, show_progress_bar=False, normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def _embed(self, documents):
+        """
+        向量化一批文档并逐个发布。单个文档出错（异常文本块、显存不足、写盘失败）只计为失败，
+        不中断整个批量任务；整批向量化失败时逐个文档重试，找出出错的文档。
+        """
+        texts = [chunk['text'] for document in documents for chunk in document['chunks']]
+        try:
+            vectors = self._encode(texts)
+        except Exception as e:
+            if len(documents) == 1:
+                self._fail(documents[0], e)
+                return
+            print(f"\n批量向量化出错，改为逐个文档处理: {str(e)}")
+            for document in documents:
+                self._embed([document])
+            return
+
+        offset = 0
+        for document in documents:
+            chunks = document['chunks']
+            document_vectors = vectors[offset:offset + len(chunks)]
+            offset += len(chunks)
+            try:
+                self._publish(document, document_vectors)
+            except Exception as e:
+                self._fail(document, e)
+
+    def _publish(self, document, vectors):
+        chunks = document['chunks']
+        metadata = [dict({key: value for key, value in chunk.items() if key != 'text'}, source=document['path'])
+                    for chunk in chunks]
+        save_embeddings(self.data_dir, document['key'], [chunk['text'] for chunk in chunks],
+                        vectors, metadata, self.model_name)
+        self.progress.add(ingested=1, pages=document['pages'], chunks=len(chunks))
+
+    def _fail(self, document, error):
+        print(f"\n向量化或保存文档时出错 {document['path']}: {str(error)}")
+        self.progress.add(failed=1)
+
+
+def ingest_directory(root, data_dir, model=None, model_name=EMBEDDING_MODEL, workers=None,
+                     batch_size=EMBED_BATCH_SIZE, chars_per_chunk=1000, stream=None):
+    """
+    批量入库目录树中的PDF，结果以 doc_<哈希>_manifest.json 等统一格式写入 data_dir
+    （与网页端共用的 processed_data），内容相同的文件只处理一次，重复运行时跳过已入库的文件。
+    提取和分块在进程池中并行执行，向量化在专用线程中跨文档拼批，两者通过有界队列衔接。
+    返回统计信息字典。
+    """
+    paths = find_pdfs(root)
+    os.makedirs(data_dir, exist_ok=True)
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+
+    progress = IngestProgress(len(paths), stream)
+    embedder = _EmbeddingWorker(model, model_name, data_dir, progress, batch_size, max_pending=workers * 2)
+    embedder.start()
+    seen = set()
+    remaining = iter(paths)
+    pending = set()
+    try:
+        # spawn：父进程已加载模型并启动了向量化线程，fork 出的子进程可能继承到被占用的锁
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            while True:
+                # 提交中的任务保持在进程数的两倍，既不让进程空闲也不一次性占满内存
+                while len(pending) < workers * 2:
+                    path = next(remaining, None)
+                    if path is None:
+                        break
+                    pending.add(pool.submit(_extract_document, path, data_dir, chars_per_chunk))
+                if not pending:
+                    break
+
+                done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"\n提取PDF时出错: {str(e)}")
+                        progress.add(failed=1)
+                        continue
+                    if result['skipped'] or result['key'] in seen:
+                        progress.add(skipped=1)
+                    elif not result['chunks']:
+                        print(f"\n无法从文件提取文本: {result['path']}")
+                        progress.add(failed=1)
+                    else:
+                        seen.add(result['key'])
+                        embedder.submit(result)
+                progress.report()
+    finally:
+        embedder.close()
+    progress.report(force=True)
+    return progress.summary()
@@ -0,0 +1,83 @@
+import re
+import numpy as np
+
+# 章节标题：第三章 / 第2节 / 3.2.1 标题 / 三、标题
+SECTION_RE = re.compile(
+    r'^\s*(第[一二三四五六七八九十百零\d]+[章节部分篇]\s*\S*'
+    r'|\d+(?:\.\d+){0,3}\s+[一-龥A-Za-z]\S*'
+    r'|[一二三四五六七八九十]+、\s*\S+)'
+)
+SECTION_MAX_LEN = 40
+PAGE_REF_RE = re.compile(r'第\s*(\d+)\s*页|[Pp]age\s*(\d+)')
+
+
+def detect_section(line):
+    """判断一行文本是否为章节标题，是则返回标题文本"""
+    line = line.strip()
+    if not line or len(line) > SECTION_MAX_LEN:
+        return None
+    match = SECTION_RE.match(line)
+    return line if match else None
+
+
+def parse_page_reference(question):
+    """从问题中解析显式页码，如“第15页”“Page12”"""
+    match = PAGE_REF_RE.search(question)
+    if not match:
+        return None
+    return int(match.group(1) or match.group(2))
+
+
+def chunk_pages(metadata):
+    """返回文本块覆盖的页码范围，兼容只有 page 字段的元数据"""
+    start = metadata.get('page_start', metadata.get('page'))
+    end = metadata.get('page_end', start)
+    if start is None:
+        return range(0)
+    return range(int(start), int(end) + 1)
+
+
+class MetadataIndex:
+    """
+    文本块元数据的倒排索引（页码 -> 块编号，章节 -> 块编号），
+    用于在打分前把候选集缩小到目标页或目标章节。
+    """
+
+    def __init__(self):
+        self.by_page = {}
+        self.by_section = {}
+        self.size = 0
+
+    def add(self, metadatas):
+        """追加一批元数据，块编号从当前总数开始连续分配"""
+        for offset, metadata in enumerate(metadatas):
+            doc_id = self.size + offset
+            for page in chunk_pages(metadata or {}):
+                self.by_page.setdefault(page, []).append(doc_id)
+            section = (metadata or {}).get('section')
+            if section:
+                self.by_section.setdefault(section, []).append(doc_id)
+        self.size += len(metadatas)
+
+    def reset(self):
+        self.by_page = {}
+        self.by_section = {}
+        self.size = 0
+
+    def candidates(self, page=None, section=None):
+        """
+        返回满足过滤条件的块编号数组；没有过滤条件时返回 None。
+        章节按子串匹配，多个条件取交集。
+        """
+        if page is None and not section:
+            return None
+        result = None
+        if page is not None:
+            result = set(self.by_page.get(int(page), []))
+        if section:
+            section_ids = set()
+            for name, ids in self.by_section.items():
+                if section in name:
+                    section_ids.update(ids)
+            result = section_ids if result is None else result & section_ids
+        return np.array(sorted(result), dtype=np.int64)
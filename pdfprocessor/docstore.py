@@ -0,0 +1,128 @@
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+try:
+    from .chunk_metadata import chunk_pages
+except ImportError:
+    from chunk_metadata import chunk_pages
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    pos INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    page_start INTEGER,
+    page_end INTEGER,
+    section TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_page ON chunks (page_start, page_end);
+CREATE INDEX IF NOT EXISTS idx_chunks_section ON chunks (section);
+"""
+
+
+class PositionIdMap(Mapping):
+    """FAISS位置到docstore编号的映射：编号就是位置本身，不需要在内存中保存整张表"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, pos):
+        if not 0 <= pos < self.index.ntotal:
+            raise KeyError(pos)
+        return str(pos)
+
+    def __iter__(self):
+        return iter(range(self.index.ntotal))
+
+    def __len__(self):
+        return self.index.ntotal
+
+
+class SQLiteDocstore(Docstore):
+    """
+    以SQLite保存文本块和元数据的docstore。
+    只在命中top-k时按位置读取，加载时不需要把整个docstore读入内存；
+    页码/章节列上建有索引，可直接用于过滤检索。
+    """
+
+    def __init__(self, db_path, read_only=True):
+        self.db_path = db_path
+        self.read_only = read_only
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite连接不能跨线程共享，每个线程各用一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.read_only:
+                conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def search(self, search):
+        row = self._conn().execute(
+            'SELECT text, metadata FROM chunks WHERE pos = ?', (int(search),)
+        ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def add(self, texts):
+        raise NotImplementedError('SQLiteDocstore 为只读，请重新构建并保存索引')
+
+    def texts(self):
+        """按位置顺序返回全部文本（仅在重建倒排索引时使用）"""
+        return [row[0] for row in self._conn().execute('SELECT text FROM chunks ORDER BY pos')]
+
+    def candidates(self, page=None, section=None):
+        """与 MetadataIndex.candidates 相同的接口，直接用SQL索引筛选候选位置"""
+        if page is None and not section:
+            return None
+        clauses, params = [], []
+        if page is not None:
+            clauses.append('page_start <= ? AND page_end >= ?')
+            params.extend([int(page), int(page)])
+        if section:
+            clauses.append("section LIKE ? ESCAPE '\\'")
+            escaped = section.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f'%{escaped}%')
+        rows = self._conn().execute(
+            f"SELECT pos FROM chunks WHERE {' AND '.join(clauses)} ORDER BY pos", params
+        ).fetchall()
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    @staticmethod
+    def write(db_path, documents):
+        """把按FAISS位置排列的文档写入新的SQLite文件（先写临时文件再替换）"""
+        tmp_path = f'{db_path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.executescript(SCHEMA)
+            rows = []
+            for pos, doc in enumerate(documents):
+                metadata = doc.metadata or {}
+                pages = chunk_pages(metadata)
+                rows.append((
+                    pos,
+                    doc.page_content,
+                    json.dumps(metadata, ensure_ascii=False),
+                    pages.start if pages else None,
+                    pages.stop - 1 if pages else None,
+                    metadata.get('section'),
+                ))
+            conn.executemany('INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_path, db_path)
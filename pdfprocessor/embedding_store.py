@@ -0,0 +1,125 @@
+import os
+import re
+import json
+import uuid
+import numpy as np
+
+try:
+    from .shared_store import GenerationCounter, SharedTexts, write_text_blob
+except ImportError:
+    from shared_store import GenerationCounter, SharedTexts, write_text_blob
+
+# 入库和知识库统一使用的向量模型（中文图纸使用bge中文模型）
+EMBEDDING_MODEL = 'BAAI/bge-large-zh-v1.5'
+FORMAT_VERSION = 1
+# 清单引用的数据文件：<键>_<版本>_<种类>，早期格式没有版本部分
+DATA_FILE_SUFFIXES = ('text.json', 'meta.json', 'vectors.npy', 'text.bin', 'text_offsets.npy')
+
+
+def manifest_path(data_dir, file_key):
+    return os.path.join(data_dir, f'{file_key}_manifest.json')
+
+
+def _write_json(path, data, **kwargs):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def save_embeddings(data_dir, file_key, texts, vectors, metadata, model_name=EMBEDDING_MODEL):
+    """
+    按统一格式保存一个文件的处理结果：
+    fileN_<版本>_text.json（文本块）、fileN_<版本>_text.bin（供mmap共享的文本）、fileN_<版本>_meta.json（元数据）、
+    fileN_<版本>_vectors.npy（float32向量）以及声明模型和维度的 fileN_manifest.json。
+    每次发布的数据文件都带随机版本号，不会覆盖其他进程正在读取的文件，
+    替换清单是唯一的提交点：读取方看到的清单总是指向同一次发布的全部文件。
+    上一次发布的文件保留（可能仍有进程刚读到旧清单），更早的删除。最后递增代数通知其他进程。
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or len(vectors) != len(texts):
+        raise ValueError(f"向量形状 {vectors.shape} 与文本块数量 {len(texts)} 不匹配")
+
+    prefix = f'{file_key}_{uuid.uuid4().hex[:8]}'
+    files = {
+        'text_file': f'{prefix}_text.json',
+        'meta_file': f'{prefix}_meta.json',
+        'vectors_file': f'{prefix}_vectors.npy',
+    }
+    texts = list(texts)
+    _write_json(os.path.join(data_dir, files['text_file']), texts)
+    _write_json(os.path.join(data_dir, files['meta_file']), metadata)
+    files['text_blob_file'], files['text_offsets_file'] = write_text_blob(data_dir, prefix, texts)
+    tmp_path = os.path.join(data_dir, f"{files['vectors_file']}.{os.getpid()}.tmp.npy")
+    np.save(tmp_path, vectors)
+    os.replace(tmp_path, os.path.join(data_dir, files['vectors_file']))
+    previous_files = _manifest_files(manifest_path(data_dir, file_key))
+
+    manifest = dict(files, **{
+        'format_version': FORMAT_VERSION,
+        'file_key': file_key,
+        'model': model_name,
+        'dimension': int(vectors.shape[1]) if len(vectors) else 0,
+        'normalized': True,
+        'count': len(texts),
+    })
+    # 清单最后写入，读取方只要看到清单就能拿到完整数据
+    _write_json(manifest_path(data_dir, file_key), manifest, indent=2)
+    _remove_stale_files(data_dir, file_key, set(files.values()) | previous_files)
+    GenerationCounter(data_dir).bump(file_key)
+    return manifest
+
+
+def _manifest_files(path):
+    """清单引用的数据文件名集合，清单不存在或无法读取时返回空集合"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {manifest[key] for key in ('text_file', 'meta_file', 'vectors_file', 'text_blob_file', 'text_offsets_file')
+            if manifest.get(key)}
+
+
+def _remove_stale_files(data_dir, file_key, keep):
+    pattern = re.compile(rf'^{re.escape(file_key)}_(?:[0-9a-f]{{8}}_)?(?:{"|".join(map(re.escape, DATA_FILE_SUFFIXES))})$')
+    for filename in os.listdir(data_dir):
+        if filename not in keep and pattern.match(filename):
+            try:
+                os.remove(os.path.join(data_dir, filename))
+            except FileNotFoundError:
+                pass
+
+
+def load_embeddings(path, model_name=None, mmap=True, shared_text=False):
+    """
+    读取统一格式的处理结果，返回 (texts, vectors, metadata, manifest)。
+    向量以内存映射方式打开；指定 model_name 时拒绝其他模型生成的向量。
+    shared_text 为 True 时文本以 SharedTexts 形式映射，多个进程共享同一份物理内存。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"不支持的数据格式版本: {manifest.get('format_version')}")
+    if model_name and manifest['model'] != model_name:
+        raise ValueError(f"向量由模型 {manifest['model']} 生成，与当前模型 {model_name} 不一致，请重新处理文件")
+
+    data_dir = os.path.dirname(path)
+    if shared_text and manifest.get('text_blob_file'):
+        texts = SharedTexts(os.path.join(data_dir, manifest['text_blob_file']),
+                            os.path.join(data_dir, manifest['text_offsets_file']))
+    else:
+        with open(os.path.join(data_dir, manifest['text_file']), 'r', encoding='utf-8') as f:
+            texts = json.load(f)
+    metadata = [{} for _ in texts]
+    meta_path = os.path.join(data_dir, manifest['meta_file'])
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    vectors = np.load(os.path.join(data_dir, manifest['vectors_file']), mmap_mode='r' if mmap else None)
+
+    if len(vectors) != manifest['count'] or len(texts) != manifest['count']:
+        raise ValueError(f"{path} 中的数据数量与清单不一致")
+    if manifest['count'] and vectors.shape[1] != manifest['dimension']:
+        raise ValueError(f"向量维度 {vectors.shape[1]} 与清单声明的 {manifest['dimension']} 不一致")
+    return texts, vectors, metadata, manifest
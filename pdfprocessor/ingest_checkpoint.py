@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import time
+import shutil
+
+import numpy as np
+
+try:
+    from .embedding_store import _write_json
+    from .page_cache import file_hash
+    from .shared_store import GenerationCounter
+except ImportError:
+    from embedding_store import _write_json
+    from page_cache import file_hash
+    from shared_store import GenerationCounter
+
+CHECKPOINT_DIR = 'checkpoints'
+# 每个检查点段包含的页数 / 文本块数
+PAGES_PER_SEGMENT = 32
+CHUNKS_PER_SEGMENT = 256
+
+SEGMENT_RE = re.compile(r'^(pages|specs|vectors)_(\d{6})\.(json|npz)$')
+
+
+class IngestCheckpoint:
+    """
+    单个文件入库过程的检查点，保存在 processed_data/checkpoints/<槽位>_<文件哈希>/ 下。
+    每完成一批页面的文本提取、规格提取或一批文本块的向量化就追加一个段文件，
+    段文件先写临时文件再替换，只会整体出现或不出现。
+    进程崩溃或重新部署后再次处理同一文件时跳过已完成的段，发布成功后删除检查点。
+    job.json 记录开始处理时该槽位的发布代数，槽位此后发布过其他文件时该任务已被取代（见 pending_jobs）。
+    """
+
+    def __init__(self, data_dir, file_key, pdf_path):
+        self.file_key = file_key
+        self.pdf_path = os.path.abspath(pdf_path)
+        self.digest = file_hash(pdf_path)
+        self.dir = os.path.join(data_dir, CHECKPOINT_DIR, f'{file_key}_{self.digest[:16]}')
+        os.makedirs(self.dir, exist_ok=True)
+        # 每次（重新）开始处理都记录当前代数：同一文件重新上传时已完成的段仍然有效
+        _write_json(os.path.join(self.dir, 'job.json'), {
+            'file_key': file_key, 'pdf_path': self.pdf_path, 'digest': self.digest,
+            'generation': GenerationCounter(data_dir).get(file_key),
+            'started': time.time_ns(),
+        })
+
+    def _segments(self, kind):
+        """按起始编号排序的段文件 [(start, path)]"""
+        segments = []
+        for filename in os.listdir(self.dir):
+            match = SEGMENT_RE.match(filename)
+            if match and match.group(1) == kind:
+                segments.append((int(match.group(2)), os.path.join(self.dir, filename)))
+        return sorted(segments)
+
+    def load_pages(self):
+        """已完成的页记录（从第1页起连续的部分）"""
+        pages = []
+        for start, path in self._segments('pages'):
+            if start != len(pages):
+                break
+            with open(path, 'r', encoding='utf-8') as f:
+                pages.extend(json.load(f))
+        return pages
+
+    def append_pages(self, start, pages):
+        _write_json(os.path.join(self.dir, f'pages_{start:06d}.json'), pages)
+
+    def load_specs(self):
+        """已完成规格提取的页面 {页码: 条目列表}"""
+        specs = {}
+        for _, path in self._segments('specs'):
+            with open(path, 'r', encoding='utf-8') as f:
+                specs.update({int(page): entries for page, entries in json.load(f).items()})
+        return specs
+
+    def append_specs(self, start, specs):
+        _write_json(os.path.join(self.dir, f'specs_{start:06d}.json'), specs)
+
+    def load_vectors(self):
+        """已向量化的文本块 {文本: 向量}"""
+        vectors = {}
+        for _, path in self._segments('vectors'):
+            with np.load(path) as data:
+                for text, vector in zip(data['texts'].tolist(), data['vectors']):
+                    vectors[text] = vector
+        return vectors
+
+    def append_vectors(self, texts, vectors):
+        # 续跑时待向量化的列表已去掉完成部分，段按顺序编号而不是按列表位置
+        number = len(self._segments('vectors'))
+        path = os.path.join(self.dir, f'vectors_{number:06d}.npz')
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, texts=np.array(texts, dtype=str), vectors=np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def pending_jobs(data_dir):
+    """
+    未完成的入库任务 [(file_key, pdf_path)]，供重启后继续处理。
+    任务开始后槽位又发布过新文件（代数已变化）时，继续处理会用旧文件覆盖较新的上传，
+    这类任务及没有记录代数的旧检查点直接删除。
+    同一槽位有多个未完成任务（连续上传后崩溃）时只继续最后开始的一个，其余删除。
+    """
+    root = os.path.join(data_dir, CHECKPOINT_DIR)
+    if not os.path.isdir(root):
+        return []
+    generations = GenerationCounter(data_dir)
+    latest = {}
+    for name in sorted(os.listdir(root)):
+        job_path = os.path.join(root, name, 'job.json')
+        if not os.path.exists(job_path):
+            continue
+        with open(job_path, 'r', encoding='utf-8') as f:
+            job = json.load(f)
+        if job.get('generation') != generations.get(job['file_key']):
+            print(f"入库任务已被槽位 {job['file_key']} 的新上传取代，删除检查点: {job['pdf_path']}")
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            continue
+        job['dir'] = os.path.join(root, name)
+        current = latest.get(job['file_key'])
+        if current is not None and current.get('started', 0) > job.get('started', 0):
+            job, current = current, job
+        if current is not None:
+            print(f"槽位 {job['file_key']} 有更新的入库任务，删除较早的检查点: {current['pdf_path']}")
+            shutil.rmtree(current['dir'], ignore_errors=True)
+        latest[job['file_key']] = job
+    return [(job['file_key'], job['pdf_path']) for _, job in sorted(latest.items())]
@@ -2,18 +2,61 @@
 import re
 import json
 from typing import List, Dict,Any
+import asyncio
 import requests
 #from pdfplumber import PDFPlumberLoader
 #from langchain.text_splitter import SemanticChunker
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
 from openai import OpenAI
+import faiss
+import numpy as np
+
+try:
+    from .text_index import InvertedIndex, reciprocal_rank_fusion
+    from .chunk_metadata import MetadataIndex, parse_page_reference
+    from .embedding_store import EMBEDDING_MODEL, _write_json, load_embeddings
+    from .docstore import PositionIdMap, SQLiteDocstore
+    from .single_flight import SingleFlight, normalize_question
+    from .llm_guard import get_llm_guard, raise_for_upstream_status
+    from .async_http import LoopLocalClient
+except ImportError:
+    from text_index import InvertedIndex, reciprocal_rank_fusion
+    from chunk_metadata import MetadataIndex, parse_page_reference
+    from embedding_store import EMBEDDING_MODEL, _write_json, load_embeddings
+    from docstore import PositionIdMap, SQLiteDocstore
+    from single_flight import SingleFlight, normalize_question
+    from llm_guard import get_llm_guard, raise_for_upstream_status
+    from async_http import LoopLocalClient
+
+API_URL = "https://api.deepseek.com/v1/chat/completions"
+API_TIMEOUT = 60
+# 保存时转换为IVF索引，每个聚类中心至少对应这么多训练向量（低于此数faiss会告警）
+IVF_MIN_POINTS_PER_LIST = 39
+IVF_MAX_LISTS = 4096
 
 class DeepSeekKnowledgeBase:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, model_name: str = EMBEDDING_MODEL):
         self.api_key = api_key
-        self.embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-large-zh-v1.5")
+        # 必须与PDFBatchProcessor入库时使用的模型一致
+        self.model_name = model_name
+        self.embeddings = HuggingFaceEmbeddings(
+            model_name=model_name,
+            encode_kwargs={"normalize_embeddings": True}
+        )
         self.vector_store = None
+        # 与FAISS向量位置一一对应的BM25倒排索引
+        self.text_index = InvertedIndex()
+        # 页码/章节元数据索引，用于过滤检索
+        self.metadata_index = MetadataIndex()
+        # 合并相同的并发查询
+        self.flight = SingleFlight()
+        # 进程内共享的DeepSeek并发限制和熔断器（与MessageHandler共用）
+        self.guard = get_llm_guard()
+        # 异步查询使用的HTTP客户端（与MessageHandler相同的复用策略）
+        self.async_http = LoopLocalClient(timeout=API_TIMEOUT)
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -59,31 +102,97 @@ class DeepSeekKnowledgeBase:
         }, ensure_ascii=False)
 
     def load_processed_data(self, json_path: str):
-        with open(json_path, 'r') as f:
+        """
+        加载PDFBatchProcessor输出的 fileN_manifest.json，直接把已有向量导入FAISS，不重新向量化。
+        清单声明的模型与当前模型不一致时抛出 ValueError。
+        也兼容旧的 {"chunks": [{text, embedding, metadata}]} 格式。
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-        texts = [chunk["text"] for chunk in data["chunks"]]
-        embeddings = [chunk["embedding"] for chunk in data["chunks"]]
-        metadatas = [chunk["metadata"] for chunk in data["chunks"]]
-        if self.vector_store is None:
-            self.vector_store = FAISS.from_embeddings(
-                text_embeddings=list(zip(texts, embeddings)),
-                embedding=self.embeddings,
-                metadatas=metadatas
-                )
+        if "chunks" in data:
+            if data.get("model") and data["model"] != self.model_name:
+                raise ValueError(f"{json_path} 的向量由模型 {data['model']} 生成，与当前模型 {self.model_name} 不一致")
+            texts = [chunk["text"] for chunk in data["chunks"]]
+            vectors = np.array([chunk["embedding"] for chunk in data["chunks"]], dtype=np.float32)
+            metadatas = [chunk["metadata"] for chunk in data["chunks"]]
         else:
-            self.vector_store.add_embeddings(
-            text_embeddings=list(zip(texts, embeddings)),
-            metadatas=metadatas
-                )
+            texts, vectors, metadatas, _ = load_embeddings(json_path, model_name=self.model_name)
+        self._add_vectors(texts, vectors, metadatas)
 
+    def _add_vectors(self, texts, vectors, metadatas):
+        """把向量直接写入FAISS索引，同时登记docstore、倒排索引和元数据索引"""
+        if len(texts) == 0:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.vector_store is None:
+            index = faiss.IndexFlatL2(vectors.shape[1])
+            self.vector_store = FAISS(
+                embedding_function=self.embeddings,
+                index=index,
+                docstore=InMemoryDocstore(),
+                index_to_docstore_id=PositionIdMap(index),
+                normalize_L2=True
+            )
+        elif isinstance(self.vector_store.docstore, SQLiteDocstore):
+            raise ValueError("通过 load_index 加载的索引为只读，请在新的知识库中加载数据后重新保存")
+        elif vectors.shape[1] != self.vector_store.index.d:
+            raise ValueError(f"向量维度 {vectors.shape[1]} 与现有索引维度 {self.vector_store.index.d} 不一致")
+        # 旧格式的向量未必归一化，复制后再归一化，避免改写内存映射的数据
+        norms = np.linalg.norm(vectors, axis=1)
+        if not np.allclose(norms, 1.0, atol=1e-3):
+            vectors = vectors.copy()
+            faiss.normalize_L2(vectors)
 
-    def query_knowledge(self, question: str, top_k=5) -> Dict[str, Any]:
-        """增强版查询方法"""
-        # 1. 增强检索
-        docs = self.vector_store.max_marginal_relevance_search(question, k=top_k)
+        # docstore编号即FAISS位置（见PositionIdMap）
+        start = self.vector_store.index.ntotal
+        self.vector_store.docstore.add({
+            str(start + i): Document(page_content=text, metadata=metadata or {})
+            for i, (text, metadata) in enumerate(zip(texts, metadatas))
+        })
+        self.vector_store.index.add(vectors)
+        # 按入库顺序追加一个倒排段，文档编号与FAISS位置保持一致
+        self.text_index.add(texts)
+        self.metadata_index.add(metadatas)
+
+    def _hybrid_search(self, question: str, top_k: int, candidates=None):
+        """向量检索与BM25关键词检索的结果做倒数排名融合；candidates 限定候选向量位置"""
+        fetch_k = top_k * 4
+        query_vector = np.array([self.embeddings.embed_query(question)], dtype=np.float32)
+        if getattr(self.vector_store, '_normalize_L2', False):
+            faiss.normalize_L2(query_vector)
+        params = None
+        if candidates is not None:
+            # 只在候选位置中检索，避免扫描整个语料；IVF索引只接受IVF检索参数
+            selector = faiss.IDSelectorBatch(candidates)
+            ivf = faiss.try_extract_index_ivf(self.vector_store.index)
+            if ivf is not None:
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+        _, positions = self.vector_store.index.search(query_vector, fetch_k, params=params)
+        vector_ranking = [int(pos) for pos in positions[0] if pos >= 0]
+        lexical_ranking = [doc_id for doc_id, _ in
+                           self.text_index.search(question, top_k=fetch_k, candidates=candidates)]
+
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking])
+        ranked = sorted(fused, key=fused.get, reverse=True)[:top_k]
+        return [self.vector_store.docstore.search(self.vector_store.index_to_docstore_id[pos])
+                for pos in ranked]
+
+
+    def retrieve(self, question: str, top_k=5, page=None, section=None):
+        """增强检索（向量 + 关键词混合检索），可按页码/章节过滤；未指定页码时从问题中识别“第N页”"""
+        if page is None:
+            page = parse_page_reference(question)
+        candidates = self.metadata_index.candidates(page=page, section=section)
+        if candidates is not None and len(candidates) == 0:
+            # 过滤后没有候选时退回全库检索
+            candidates = None
+        return self._hybrid_search(question, top_k, candidates)
+
+    def _build_payload(self, question: str, docs) -> Dict[str, Any]:
+        """构建消息列表和请求体"""
         context = "\n".join([f"知识片段{i+1}: {doc.page_content}" for i, doc in enumerate(docs)])
-        
-        # 2. 构建消息列表
         messages = [
             {
                 "role": "system",
@@ -94,25 +203,19 @@ class DeepSeekKnowledgeBase:
                 "content": f"当前图纸问题：{question}\n相关知识库内容：{context}"
             }
         ]
-        
-        # 3. API调用
-        payload = {
+        return {
             "model": "deepseek-chat",
             "messages": messages,
             "temperature": 0.1,
             "max_tokens": 2000,
             "response_format": {"type": "json_object"}  # 强制JSON输出
         }
-        
-        response = requests.post(
-            "https://api.deepseek.com/v1/chat/completions",
-            headers=self.headers,
-            json=payload
-        )
 
-        # 4. 增强解析
+    @staticmethod
+    def _parse_response(response_json: Dict[str, Any], raw_text: str, docs) -> Dict[str, Any]:
+        """增强解析"""
         try:
-            result = json.loads(response.json()["choices"][0]["message"]["content"])
+            result = json.loads(response_json["choices"][0]["message"]["content"])
             return {
                 "status": "success",
                 "data": result,
@@ -125,26 +228,138 @@ class DeepSeekKnowledgeBase:
             return {
                 "status": "error",
                 "message": "Invalid JSON format",
-                "raw_response": response.text
+                "raw_response": raw_text
             }
 
+    def _flight_key(self, question: str, top_k, page, section):
+        """合并键：规范化后的问题、检索参数和知识库版本（向量总数）"""
+        version = (id(self.vector_store), self.vector_store.index.ntotal)
+        return (normalize_question(question), top_k, page, section, version)
+
+    def query_knowledge(self, question: str, top_k=5, page=None, section=None) -> Dict[str, Any]:
+        """增强版查询方法；相同问题的并发查询只检索和调用API一次"""
+        return self.flight.do(self._flight_key(question, top_k, page, section),
+                              self._query_knowledge, question, top_k, page, section)
+
+    def _query_knowledge(self, question: str, top_k=5, page=None, section=None) -> Dict[str, Any]:
+        # 1. 增强检索
+        docs = self.retrieve(question, top_k, page, section)
+        
+        # 2. 构建消息列表
+        payload = self._build_payload(question, docs)
+        
+        # 3. API调用（经过并发限制和熔断器，服务端错误和限流计为失败，见 is_upstream_failure）
+        with self.guard.slot():
+            response = requests.post(
+                API_URL,
+                headers=self.headers,
+                json=payload,
+                timeout=API_TIMEOUT
+            )
+            raise_for_upstream_status(response)
+
+        # 4. 增强解析
+        return self._parse_response(response.json(), response.text, docs)
+
+    async def aquery_knowledge(self, question: str, top_k=5, page=None, section=None,
+                               executor=None) -> Dict[str, Any]:
+        """
+        query_knowledge 的异步版本：检索（向量化 + FAISS + BM25）放到 executor 中执行，
+        API调用使用异步HTTP客户端，等待期间不占用线程。相同问题的并发查询共享同一次计算。
+        """
+        return await self.flight.do_async(self._flight_key(question, top_k, page, section),
+                                          self._aquery_knowledge, question, top_k, page, section, executor)
+
+    async def _aquery_knowledge(self, question: str, top_k, page, section, executor) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        docs = await loop.run_in_executor(executor, self.retrieve, question, top_k, page, section)
+        payload = self._build_payload(question, docs)
+        async with self.guard.aslot():
+            async with self.async_http.client() as client:
+                response = await client.post(API_URL, headers=self.headers, json=payload)
+            raise_for_upstream_status(response)
+        return self._parse_response(response.json(), response.text, docs)
+
     def save_index(self, path: str):
-        """保存向量索引"""
+        """
+        保存向量索引：FAISS索引写为 index.faiss，文本块和元数据写入 docstore.sqlite，
+        不再pickle整个docstore。
+        通过 load_index 加载的索引只读且映射自原文件（倒排表指向原 index.faiss），不能再次保存。
+        """
+        if isinstance(getattr(self.vector_store, 'docstore', None), SQLiteDocstore):
+            raise ValueError("通过 load_index 加载的索引为只读，已经保存在原目录中，请在新的知识库中加载数据后重新保存")
         if self.vector_store is not None:
-            # 添加安全序列化配置
-            self.vector_store.save_local(
-                folder_path=path,
-                index_name="index.faiss",
-                create_path=True
+            os.makedirs(path, exist_ok=True)
+            docstore = self.vector_store.docstore
+            ntotal = self.vector_store.index.ntotal
+            SQLiteDocstore.write(
+                os.path.join(path, "docstore.sqlite"),
+                (docstore.search(self.vector_store.index_to_docstore_id[pos]) for pos in range(ntotal))
             )
+            tmp_path = os.path.join(path, f"index.faiss.{os.getpid()}.tmp")
+            faiss.write_index(self._to_ivf(self.vector_store.index), tmp_path)
+            os.replace(tmp_path, os.path.join(path, "index.faiss"))
+            _write_json(os.path.join(path, "index_meta.json"),
+                        {"model": self.model_name, "dimension": self.vector_store.index.d, "count": ntotal})
+            self.text_index.save(os.path.join(path, "lexical"))
+
+    @staticmethod
+    def _to_ivf(index):
+        """
+        把内存中的 IndexFlatL2 转换为 IndexIVFFlat 再保存。
+        faiss 1.10 的 IO_FLAG_MMAP 只映射IVF倒排表，平坦索引读取时仍会把全部向量读入内存。
+        nprobe 等于聚类数，检索仍是精确的全量比较，结果与平坦索引一致。
+        """
+        if index.ntotal == 0:
+            return index
+        vectors = index.reconstruct_n(0, index.ntotal)
+        nlist = int(min(IVF_MAX_LISTS, np.sqrt(index.ntotal), index.ntotal // IVF_MIN_POINTS_PER_LIST)) or 1
+        ivf = faiss.IndexIVFFlat(faiss.IndexFlatL2(index.d), index.d, nlist)
+        # 向量数已按聚类数约束，语料很少时只有一个聚类，不需要训练量告警
+        ivf.cp.min_points_per_centroid = 1
+        ivf.train(vectors)
+        # 按顺序添加，IVF中的编号即原来的FAISS位置（见PositionIdMap）
+        ivf.add(vectors)
+        ivf.nprobe = nlist
+        return ivf
+
+    @staticmethod
+    def _read_index(index_path: str):
+        """以内存映射方式只读打开FAISS索引（IVF倒排表直接映射，不读入内存）"""
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        if faiss.try_extract_index_ivf(index) is None:
+            print(f"警告: {index_path} 为旧格式的平坦索引，已整体读入内存，请用 save_index 重新保存")
+        return index
+
 
-            
     def load_index(self, path: str):
-        """加载向量索引"""
-        self.vector_store = FAISS.load_local(
-            folder_path=path,
-            embeddings=self.embeddings,
-            index_name="index.faiss",
-            allow_dangerous_deserialization=True,  # 显式启用安全风险确认
-            normalize_L2=True  # 添加归一化选项
-        )
\ No newline at end of file
+        """
+        加载向量索引。索引以内存映射方式打开，docstore留在SQLite中，
+        查询时只读取top-k命中的文本块，启动时间和常驻内存基本与语料规模无关。
+        加载后的索引为只读，新增数据需重新构建并保存。
+        """
+        db_path = os.path.join(path, "docstore.sqlite")
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"{path} 中没有 docstore.sqlite，请用 save_index 重新生成索引")
+        with open(os.path.join(path, "index_meta.json"), 'r', encoding='utf-8') as f:
+            index_meta = json.load(f)
+        if index_meta["model"] != self.model_name:
+            raise ValueError(f"索引由模型 {index_meta['model']} 生成，与当前模型 {self.model_name} 不一致")
+
+        index = self._read_index(os.path.join(path, "index.faiss"))
+        docstore = SQLiteDocstore(db_path)
+        self.vector_store = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=PositionIdMap(index),
+            normalize_L2=True
+        )
+        # 页码/章节过滤直接走SQLite索引
+        self.metadata_index = docstore
+        self.text_index = InvertedIndex.load(os.path.join(path, "lexical"))
+        if len(self.text_index) != index.ntotal:
+            # 倒排数据缺失时按FAISS位置顺序重建
+            self.text_index = InvertedIndex()
+            self.text_index.add(docstore.texts())
+            self.text_index.save(os.path.join(path, "lexical"))
@@ -0,0 +1,223 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class LLMUnavailable(Exception):
+    """大模型调用被拒绝（熔断器打开），retry_after 为建议的重试秒数"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMOverloaded(LLMUnavailable):
+    """并发已满且等待队列已满，或排队超时"""
+
+
+def is_upstream_failure(status_code):
+    """
+    熔断统计的失败判定（MessageHandler 和 DeepSeekKnowledgeBase 共用）：
+    5xx、429（限流）和 408（超时）说明服务端过载或故障，计为失败；
+    其他 4xx（密钥错误、请求格式错误）是调用方的问题，重试和熔断都无济于事，不计入。
+    """
+    return status_code >= 500 or status_code in (408, 429)
+
+
+def raise_for_upstream_status(response):
+    """在 guard.slot()/aslot() 内调用：服务端故障时抛出HTTP错误，使本次调用计为失败"""
+    if is_upstream_failure(response.status_code):
+        response.raise_for_status()
+
+
+class _Waiter:
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class LLMGuard:
+    """
+    DeepSeek调用的准入控制：
+    - 最多 max_concurrent 个并发调用，超出的请求进入长度为 max_queue 的等待队列，
+      队列已满或等待超过 queue_timeout 秒时立即失败；
+    - 熔断器：最近 window 次调用中失败（异常或耗时超过 slow_call_seconds）比例达到
+      failure_ratio 时打开，open_seconds 内直接拒绝，之后放行一个探测请求决定是否恢复。
+    同步（线程）和异步（事件循环）调用共用同一组计数。
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=32, queue_timeout=10.0,
+                 window=20, min_calls=10, failure_ratio=0.5, slow_call_seconds=20.0, open_seconds=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+        self._outcomes = deque(maxlen=window)
+        self._state = 'closed'
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    # ---- 熔断器 ----
+
+    def _check_circuit_locked(self):
+        """返回本次调用是否为半开状态下的探测请求；熔断打开时抛出 LLMUnavailable"""
+        if self._state == 'closed':
+            return False
+        remaining = self._opened_at + self.open_seconds - time.monotonic()
+        if remaining > 0:
+            raise LLMUnavailable("DeepSeek服务暂时不可用，请稍后再试", retry_after=remaining)
+        if self._probe_in_flight:
+            raise LLMUnavailable("DeepSeek服务正在恢复中，请稍后再试", retry_after=1.0)
+        self._state = 'half_open'
+        self._probe_in_flight = True
+        return True
+
+    def _record(self, success, probe):
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+                if success:
+                    self._state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._open_locked()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (self._state == 'closed' and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_ratio):
+                self._open_locked()
+
+    def _open_locked(self):
+        self._state = 'open'
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        print(f"DeepSeek调用熔断器已打开，{self.open_seconds:.0f} 秒内直接拒绝请求")
+
+    # ---- 并发限制 ----
+
+    def _retry_after_locked(self):
+        # 粗略估计：排在前面的请求按每个慢调用耗时分批完成
+        batches = len(self._waiters) // max(self.max_concurrent, 1) + 1
+        return min(batches * self.slow_call_seconds, 60.0)
+
+    def _enter_locked(self, wake):
+        """尝试占用并发名额；返回 (probe, waiter)，waiter 为 None 表示已直接获得名额"""
+        probe = self._check_circuit_locked()
+        if self._active < self.max_concurrent:
+            self._active += 1
+            return probe, None
+        if len(self._waiters) >= self.max_queue:
+            if probe:
+                self._probe_in_flight = False
+            raise LLMOverloaded("当前请求过多，请稍后再试", retry_after=self._retry_after_locked())
+        waiter = _Waiter(wake)
+        self._waiters.append(waiter)
+        return probe, waiter
+
+    def _abandon(self, waiter, probe):
+        """等待超时：已被分配名额则继续执行，否则退出队列并失败"""
+        with self._lock:
+            if waiter.granted:
+                return
+            self._waiters.remove(waiter)
+            if probe:
+                self._probe_in_flight = False
+            raise LLMOverloaded("排队等待超时，请稍后再试", retry_after=self._retry_after_locked())
+
+    def _cancel(self, waiter, probe):
+        """排队中的调用被取消：退出队列；已被分配名额时把名额交还"""
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            if self._waiters:
+                # 名额直接交给下一个等待者
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self._active -= 1
+
+    @contextmanager
+    def slot(self):
+        """同步调用：with guard.slot(): requests.post(...)"""
+        event = threading.Event()
+        with self._lock:
+            probe, waiter = self._enter_locked(event.set)
+        if waiter is not None and not event.wait(self.queue_timeout):
+            self._abandon(waiter, probe)
+
+        started = time.monotonic()
+        success = False
+        try:
+            yield
+            success = time.monotonic() - started <= self.slow_call_seconds
+        finally:
+            self._release()
+            self._record(success, probe)
+
+    @asynccontextmanager
+    async def aslot(self):
+        """异步调用：async with guard.aslot(): await client.post(...)，排队时不占用线程"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            probe, waiter = self._enter_locked(wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._abandon(waiter, probe)
+            except BaseException:
+                # CancelledError（如客户端断开）不会走到 _abandon，必须在这里退出队列
+                self._cancel(waiter, probe)
+                raise
+
+        started = time.monotonic()
+        success = False
+        try:
+            yield
+            success = time.monotonic() - started <= self.slow_call_seconds
+        finally:
+            self._release()
+            self._record(success, probe)
+
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+def get_llm_guard():
+    """进程内共享的 LLMGuard，MessageHandler 和 DeepSeekKnowledgeBase 共用；参数可用环境变量调整"""
+    global _guard
+    with _guard_lock:
+        if _guard is None:
+            _guard = LLMGuard(
+                max_concurrent=int(os.environ.get('LLM_MAX_CONCURRENT', 8)),
+                max_queue=int(os.environ.get('LLM_MAX_QUEUE', 32)),
+                queue_timeout=float(os.environ.get('LLM_QUEUE_TIMEOUT', 10)),
+                slow_call_seconds=float(os.environ.get('LLM_SLOW_CALL_SECONDS', 20)),
+                open_seconds=float(os.environ.get('LLM_CIRCUIT_OPEN_SECONDS', 30)),
+            )
+        return _guard
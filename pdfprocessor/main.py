@@ -35,7 +35,7 @@ class PDFComparisonSystem:
         # 步骤2：构建知识库
         print("\n构建向量知识库...")
         json_files = [f for f in os.listdir(self.config["processed_dir"]) 
-                     if f.endswith('.json')]
+                     if f.endswith('_manifest.json')]
         
         for json_file in json_files:
             self.kb.load_processed_data(
@@ -0,0 +1,322 @@
+import os
+import re
+import math
+import json
+import hashlib
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from .single_flight import SingleFlight
+except ImportError:
+    from single_flight import SingleFlight
+
+# 缩略图宽度（像素）
+THUMB_WIDTH = 256
+# 瓦片边长（像素）
+TILE_SIZE = 512
+# 上传后预渲染的缩放级别（1 表示 72dpi）
+PRERENDER_ZOOMS = (1, 2)
+# 每个渲染任务处理的页数
+PAGES_PER_TASK = 8
+# 按需渲染（浏览时未命中的缩略图/瓦片）和读取页面尺寸使用的独立进程数，不排在预渲染任务后面
+INTERACTIVE_WORKERS = 2
+# 请求线程等待按需渲染的最长秒数
+RENDER_TIMEOUT = 20
+# 整页瓦片全部生成后写入的标记文件
+TILES_COMPLETE_MARKER = '.complete'
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def file_hash(file_path, block_size=1024 * 1024):
+    """计算文件内容的SHA-256，用作缓存键"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _atomic_save(image, path):
+    """先写唯一命名的临时文件再替换，避免并发读到半个PNG，多个渲染任务同时写同一瓦片也互不影响"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format='PNG', optimize=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_page_sizes(pdf_path):
+    """在子进程中读取各页尺寸（PDFium不是线程安全的，所有调用都放在渲染进程池中）"""
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return [list(pdf.get_page_size(i)) for i in range(len(pdf))]
+    finally:
+        pdf.close()
+
+
+def _pixels_to_points(pixels, zoom):
+    """
+    把裁掉的像素数换算为 render(crop=...) 使用的PDF单位。
+    pypdfium2 会按 ceil(crop * scale) 取整，减去半个像素避免浮点误差多裁一个像素。
+    """
+    return max(pixels - 0.5, 0) / zoom
+
+
+def _render_pages(pdf_path, doc_dir, page_indices, zooms, thumb_width=THUMB_WIDTH, tile_size=TILE_SIZE):
+    """
+    在子进程中渲染指定页面的缩略图和瓦片。
+    每个任务只打开一次PDF文档，逐页渲染后立即释放位图。
+    """
+    import pypdfium2 as pdfium
+
+    written = 0
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for index in page_indices:
+            page = pdf[index]
+            try:
+                width, height = page.get_size()
+                thumb_path = os.path.join(doc_dir, 'thumbs', f'{index}.png')
+                if not os.path.exists(thumb_path):
+                    image = page.render(scale=thumb_width / width).to_pil()
+                    _atomic_save(image, thumb_path)
+                    written += os.path.getsize(thumb_path)
+
+                for zoom in zooms:
+                    tile_dir = os.path.join(doc_dir, 'tiles', str(zoom), str(index))
+                    marker_path = os.path.join(tile_dir, TILES_COMPLETE_MARKER)
+                    if os.path.exists(marker_path):
+                        continue
+                    # 逐个瓦片裁剪渲染，不在内存中生成整页大图（A0图纸在高缩放级别下可达上亿像素）
+                    full_width, full_height = math.ceil(width * zoom), math.ceil(height * zoom)
+                    for top in range(0, full_height, tile_size):
+                        for left in range(0, full_width, tile_size):
+                            right = min(left + tile_size, full_width)
+                            bottom = min(top + tile_size, full_height)
+                            crop = [_pixels_to_points(pixels, zoom)
+                                    for pixels in (left, full_height - bottom, full_width - right, top)]
+                            tile = page.render(scale=zoom, crop=crop).to_pil()
+                            tile_path = os.path.join(tile_dir, f'{left // tile_size}_{top // tile_size}.png')
+                            _atomic_save(tile, tile_path)
+                            written += os.path.getsize(tile_path)
+                    open(marker_path, 'w').close()
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+    return written
+
+
+class PageRenderCache:
+    """
+    以PDF内容哈希为键的页面缩略图/瓦片缓存。
+    上传时在进程池中预渲染，未命中时在另一个小进程池中按需渲染（同一页同一缩放级别的并发请求只渲染一次），
+    按需渲染和读取页面尺寸不会排在整份文档的预渲染任务后面。
+    超出容量时按最近访问时间淘汰。PDFium不是线程安全的，请求线程中从不直接调用。
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, max_workers=None, prerender_zooms=PRERENDER_ZOOMS):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.prerender_zooms = tuple(prerender_zooms)
+        self._executor = None
+        self._interactive_executor = None
+        self._lock = threading.Lock()
+        self._bytes_since_evict = 0
+        self._flight = SingleFlight()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_executor(self):
+        """预渲染进程池"""
+        with self._lock:
+            if self._executor is None:
+                # spawn：web进程中已有多个线程并加载了torch，fork 出的子进程可能继承到被占用的锁
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _get_interactive_executor(self):
+        """按需渲染和读取页面尺寸的进程池，请求线程在其上等待结果"""
+        with self._lock:
+            if self._interactive_executor is None:
+                self._interactive_executor = ProcessPoolExecutor(
+                    max_workers=min(INTERACTIVE_WORKERS, self.max_workers),
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._interactive_executor
+
+    def doc_dir(self, doc_hash):
+        return os.path.join(self.cache_dir, doc_hash)
+
+    def load_meta(self, doc_hash):
+        """读取文档元数据（源文件路径、页数、页面尺寸）"""
+        if not HASH_RE.match(doc_hash):
+            return None
+        meta_path = os.path.join(self.doc_dir(doc_hash), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def register(self, pdf_path):
+        """登记PDF文件并写入元数据，返回内容哈希"""
+        doc_hash = file_hash(pdf_path)
+        meta = self.load_meta(doc_hash)
+        if meta is not None and os.path.exists(meta['source']):
+            return doc_hash
+
+        page_sizes = self._get_interactive_executor().submit(_read_page_sizes, pdf_path).result(RENDER_TIMEOUT)
+
+        meta = {
+            'source': os.path.abspath(pdf_path),
+            'page_count': len(page_sizes),
+            'page_sizes': page_sizes,
+            'thumb_width': THUMB_WIDTH,
+            'tile_size': TILE_SIZE,
+        }
+        doc_dir = self.doc_dir(doc_hash)
+        os.makedirs(doc_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=doc_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(doc_dir, 'meta.json'))
+        return doc_hash
+
+    def prerender(self, pdf_path):
+        """登记文件并在后台进程池中预渲染所有页面，立即返回内容哈希"""
+        try:
+            doc_hash = self.register(pdf_path)
+        except Exception as e:
+            # 预渲染失败不影响上传，页面仍可由PDF.js直接渲染
+            print(f"登记PDF页面缓存时出错: {str(e)}")
+            return None
+        meta = self.load_meta(doc_hash)
+        executor = self._get_executor()
+        page_indices = list(range(meta['page_count']))
+        for start in range(0, len(page_indices), PAGES_PER_TASK):
+            future = executor.submit(_render_pages, meta['source'], self.doc_dir(doc_hash),
+                                     page_indices[start:start + PAGES_PER_TASK], self.prerender_zooms)
+            future.add_done_callback(self._on_rendered)
+        print(f"已提交 {meta['page_count']} 页的预渲染任务: {doc_hash[:12]}")
+        return doc_hash
+
+    def _on_rendered(self, future):
+        try:
+            written = future.result()
+        except Exception as e:
+            print(f"预渲染页面时出错: {str(e)}")
+            return
+        self._record_written(written)
+
+    def _record_written(self, written):
+        with self._lock:
+            self._bytes_since_evict += written
+            # 每写入约5%的容量检查一次，避免频繁遍历目录
+            if self._bytes_since_evict < self.max_bytes // 20:
+                return
+            self._bytes_since_evict = 0
+        self.evict()
+
+    def _ensure_rendered(self, doc_hash, page, zoom=None):
+        meta = self.load_meta(doc_hash)
+        if meta is None or not 0 <= page < meta['page_count']:
+            return None
+        zooms = (zoom,) if zoom is not None else ()
+        # 瓦片查看器会同时请求一页的所有瓦片：合并为一次渲染，并交给进程池执行
+        self._flight.do((doc_hash, page, zoom), self._render_in_pool,
+                        meta['source'], self.doc_dir(doc_hash), page, zooms)
+        return meta
+
+    def _render_in_pool(self, pdf_path, doc_dir, page, zooms):
+        """超过 RENDER_TIMEOUT 未完成时抛出 TimeoutError（渲染继续进行，结果写入缓存）"""
+        future = self._get_interactive_executor().submit(_render_pages, pdf_path, doc_dir, [page], zooms)
+        written = future.result(RENDER_TIMEOUT)
+        if written:
+            self._record_written(written)
+        return written
+
+    def thumbnail_path(self, doc_hash, page):
+        """返回缩略图相对缓存目录的路径，不存在时同步渲染"""
+        if not HASH_RE.match(doc_hash):
+            return None
+        rel_path = os.path.join(doc_hash, 'thumbs', f'{page}.png')
+        if not self._touch(rel_path):
+            if self._ensure_rendered(doc_hash, page) is None:
+                return None
+        return rel_path
+
+    def tile_path(self, doc_hash, page, zoom, x, y):
+        """返回瓦片相对缓存目录的路径，不存在时同步渲染整页瓦片"""
+        if not HASH_RE.match(doc_hash):
+            return None
+        rel_path = os.path.join(doc_hash, 'tiles', str(zoom), str(page), f'{x}_{y}.png')
+        if not self._touch(rel_path):
+            if self._ensure_rendered(doc_hash, page, zoom) is None:
+                return None
+            if not os.path.exists(os.path.join(self.cache_dir, rel_path)):
+                return None
+        return rel_path
+
+    def _touch(self, rel_path):
+        """更新访问时间（用于LRU淘汰），文件不存在时返回False"""
+        path = os.path.join(self.cache_dir, rel_path)
+        try:
+            # 只改atime，保留mtime以免媒体视图的ETag失效
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def evict(self):
+        """按最近访问时间删除最旧的PNG，直到缓存总大小低于上限的90%"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.png'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat_result.st_atime, stat_result.st_size, path))
+                total += stat_result.st_size
+
+        if total <= self.max_bytes:
+            return 0
+
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                # 瓦片不再完整，去掉标记以便按需重新渲染
+                os.remove(os.path.join(os.path.dirname(path), TILES_COMPLETE_MARKER))
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        # 清理空目录
+        for root, dirs, files in os.walk(self.cache_dir, topdown=False):
+            if root != self.cache_dir and not dirs and not files:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+        print(f"页面缓存淘汰了 {removed} 个文件")
+        return removed
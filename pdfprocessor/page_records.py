@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+try:
+    from .embedding_store import _write_json
+except ImportError:
+    from embedding_store import _write_json
+
+# 版本 3：页面哈希包含页面资源（Form XObject、字体、图像），内容流按原始字节计入，旧记录不再复用
+PAGE_RECORDS_VERSION = 3
+
+
+def page_records_path(data_dir, file_key):
+    return os.path.join(data_dir, f'{file_key}_pages.json')
+
+
+def _page_resources(page):
+    """页面的 /Resources，页面本身没有时沿页面树向上继承"""
+    node = page
+    while node is not None:
+        if '/Resources' in node:
+            return node['/Resources']
+        parent = node.get('/Parent')
+        node = parent.get_object() if parent is not None else None
+    return None
+
+
+def _hash_object(obj, digest, seen, stream_cache):
+    """
+    按确定顺序把PDF对象递归写入哈希：字典按键排序，间接引用展开为被引用的对象。
+    不写入对象编号（修订版重新保存时编号会变），重复引用只写入首次出现的序号，同时避免循环引用。
+    """
+    if isinstance(obj, IndirectObject):
+        ref = (obj.idnum, obj.generation)
+        if ref in seen:
+            digest.update(b'@%d' % seen[ref])
+            return
+        seen[ref] = len(seen)
+        if isinstance(obj.get_object(), StreamObject):
+            # 字体、图像等流数据在各页之间共享，原始字节的摘要按对象缓存，每个文件只计算一次
+            if ref not in stream_cache:
+                stream_cache[ref] = hashlib.sha1(obj.get_object()._data).digest()
+            _hash_object(DictionaryObject(obj.get_object()), digest, seen, stream_cache)
+            digest.update(b'stream' + stream_cache[ref])
+            return
+        obj = obj.get_object()
+
+    if isinstance(obj, StreamObject):
+        _hash_object(DictionaryObject(obj), digest, seen, stream_cache)
+        digest.update(b'stream' + hashlib.sha1(obj._data).digest())
+    elif isinstance(obj, DictionaryObject):
+        digest.update(b'<<')
+        for key in sorted(obj):
+            digest.update(str(key).encode('utf-8'))
+            _hash_object(obj.raw_get(key), digest, seen, stream_cache)
+        digest.update(b'>>')
+    elif isinstance(obj, ArrayObject):
+        digest.update(b'[')
+        for item in obj:
+            _hash_object(item, digest, seen, stream_cache)
+        digest.update(b']')
+    else:
+        digest.update(f'{type(obj).__name__}:{obj!r};'.encode('utf-8'))
+
+
+def page_hash(page, stream_cache=None):
+    """
+    页面内容哈希：内容流字节 + 页面尺寸 + 页面资源。
+    资源递归展开 Form XObject（内容流中 /Fm0 Do 绘制的文字不在页面内容流里）、字体和图像，
+    资源变化或不同页面共用同一内容流时哈希都能区分。
+    不需要提取文本即可判断页面是否变化，修订版中未改动的页面哈希保持不变。
+    stream_cache 在同一文件的各页之间共享，避免重复计算共享字体/图像的摘要。
+    """
+    digest = hashlib.sha1()
+    seen = {}
+    stream_cache = {} if stream_cache is None else stream_cache
+    # /Contents 可以是单个流，也可以是流的数组（CAD导出和增量保存的PDF很常见），逐个流计入哈希
+    contents = page.raw_get('/Contents') if '/Contents' in page else None
+    if contents is not None:
+        _hash_object(contents, digest, seen, stream_cache)
+    digest.update(repr([float(v) for v in page.mediabox]).encode('ascii'))
+    resources = _page_resources(page)
+    if resources is not None:
+        _hash_object(resources, digest, seen, stream_cache)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    """页面结构无法计算哈希时的退路：按提取出的文本计算（带前缀，不会与 page_hash 混淆）"""
+    return 'text:' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def load_page_records(data_dir, file_key):
+    """
+    读取上次入库时保存的逐页记录，返回按页顺序排列的列表：
+    [{'hash': ..., 'text': ..., 'specs': [...] 或 None}, ...]；没有记录时返回空列表。
+    """
+    path = page_records_path(data_dir, file_key)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('format_version') != PAGE_RECORDS_VERSION:
+            return []
+        return data['pages']
+    except Exception as e:
+        print(f"读取逐页记录时出错: {str(e)}")
+        return []
+
+
+def save_page_records(data_dir, file_key, records):
+    _write_json(page_records_path(data_dir, file_key),
+                {'format_version': PAGE_RECORDS_VERSION, 'pages': records})
@@ -1,55 +1,143 @@
 import os
-import pickle
 import json
 import numpy as np
-from PyPDF2 import PdfReader  # 使用PyPDF2代替PyMuPDF
 from sentence_transformers import SentenceTransformer
 
+try:
+    from .spec_index import SpecIndex, extract_specs_from_pdf
+    from .text_index import InvertedIndex, reciprocal_rank_fusion
+    from .chunk_metadata import MetadataIndex
+    from .embedding_store import EMBEDDING_MODEL, load_embeddings, manifest_path, save_embeddings
+    from .shared_store import GenerationCounter
+    from .page_records import load_page_records, save_page_records
+    from .pdf_text import chunk_page_texts, extract_pages
+    from .bulk_ingest import ingest_directory
+    from .ingest_checkpoint import CHUNKS_PER_SEGMENT, PAGES_PER_SEGMENT, IngestCheckpoint, pending_jobs
+except ImportError:
+    from spec_index import SpecIndex, extract_specs_from_pdf
+    from text_index import InvertedIndex, reciprocal_rank_fusion
+    from chunk_metadata import MetadataIndex
+    from embedding_store import EMBEDDING_MODEL, load_embeddings, manifest_path, save_embeddings
+    from shared_store import GenerationCounter
+    from page_records import load_page_records, save_page_records
+    from pdf_text import chunk_page_texts, extract_pages
+    from bulk_ingest import ingest_directory
+    from ingest_checkpoint import CHUNKS_PER_SEGMENT, PAGES_PER_SEGMENT, IngestCheckpoint, pending_jobs
+
 class PDFBatchProcessor:
-    def __init__(self):
-        # 初始化向量模型
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        # 初始化向量模型（与知识库使用同一个模型，结果可直接导入FAISS）
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
         # 用于保存已处理文件的文本和向量的字典
         self.processed_files = {
-            'file1': {'text': [], 'vectors': []},
-            'file2': {'text': [], 'vectors': []}
+            'file1': {'text': [], 'vectors': [], 'metadata': []},
+            'file2': {'text': [], 'vectors': [], 'metadata': []}
         }
         # 用于存储临时数据的目录
         self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'processed_data')
         os.makedirs(self.data_dir, exist_ok=True)
+        # 尺寸/公差/材料规格索引
+        self.spec_index = SpecIndex(self.data_dir)
+        # 每个文件的BM25倒排索引
+        self.text_indexes = {'file1': InvertedIndex(), 'file2': InvertedIndex()}
+        # 每个文件的页码/章节索引，用于过滤检索
+        self.metadata_indexes = {'file1': MetadataIndex(), 'file2': MetadataIndex()}
+        # 多进程共享的代数计数器：其他进程发布新数据后在这里可见
+        self.generations = GenerationCounter(self.data_dir)
+        self.loaded_generations = {}
         
         # 尝试从持久化存储加载已处理的数据
         self.load_processed_data()
+        self.spec_index.load()
     
     def load_processed_data(self):
         """从持久化存储加载已处理的数据"""
         for file_key in ['file1', 'file2']:
-            text_path = os.path.join(self.data_dir, f'{file_key}_text.json')
-            vectors_path = os.path.join(self.data_dir, f'{file_key}_vectors.pkl')
-            
-            if os.path.exists(text_path) and os.path.exists(vectors_path):
-                try:
-                    with open(text_path, 'r', encoding='utf-8') as f:
-                        self.processed_files[file_key]['text'] = json.load(f)
-                    
-                    with open(vectors_path, 'rb') as f:
-                        self.processed_files[file_key]['vectors'] = pickle.load(f)
-                        
-                    print(f"已加载 {file_key} 的处理数据: {len(self.processed_files[file_key]['text'])} 个文本块")
-                except Exception as e:
-                    print(f"加载处理数据时出错: {str(e)}")
+            self.load_slot(file_key)
     
-    def save_processed_data(self, file_key):
-        """将处理后的数据保存到持久化存储"""
-        text_path = os.path.join(self.data_dir, f'{file_key}_text.json')
-        vectors_path = os.path.join(self.data_dir, f'{file_key}_vectors.pkl')
-        
+    def load_slot(self, file_key):
+        """
+        以只读mmap方式挂载一个文件的已发布数据（向量、文本、倒排索引）。
+        多个worker挂载同一份文件时共享操作系统页缓存，不会各自复制一份。
+        """
+        path = manifest_path(self.data_dir, file_key)
         try:
-            with open(text_path, 'w', encoding='utf-8') as f:
-                json.dump(self.processed_files[file_key]['text'], f, ensure_ascii=False)
+            if not os.path.exists(path) and not self._migrate_legacy(file_key):
+                return
+            
+            # 先读代数再加载：加载期间若有新发布，下次refresh会再次加载
+            generation = self.generations.get(file_key)
+            texts, vectors, metadata, manifest = load_embeddings(path, shared_text=True)
+            if manifest['model'] != self.model_name:
+                # 其他模型生成的向量不能混用，用当前模型重新向量化
+                print(f"{file_key} 的向量由 {manifest['model']} 生成，正在用 {self.model_name} 重新向量化")
+                save_embeddings(self.data_dir, file_key, list(texts), self.vectorize_text(list(texts)),
+                                metadata, self.model_name)
+                generation = self.generations.get(file_key)
+                texts, vectors, metadata, manifest = load_embeddings(path, shared_text=True)
             
-            with open(vectors_path, 'wb') as f:
-                pickle.dump(self.processed_files[file_key]['vectors'], f)
+            self.processed_files[file_key]['text'] = texts
+            self.processed_files[file_key]['vectors'] = vectors
+            self.processed_files[file_key]['metadata'] = metadata
+            self.metadata_indexes[file_key] = MetadataIndex()
+            self.metadata_indexes[file_key].add(metadata)
+                
+            print(f"已加载 {file_key} 的处理数据: {len(texts)} 个文本块")
+            self.load_text_index(file_key)
+            self.loaded_generations[file_key] = generation
+        except Exception as e:
+            print(f"加载处理数据时出错: {str(e)}")
+    
+    def _migrate_legacy(self, file_key):
+        """旧格式（pickle向量，模型未声明）：用当前模型重新向量化并保存为统一格式"""
+        text_path = os.path.join(self.data_dir, f'{file_key}_text.json')
+        legacy_vectors_path = os.path.join(self.data_dir, f'{file_key}_vectors.pkl')
+        if not (os.path.exists(text_path) and os.path.exists(legacy_vectors_path)):
+            return False
+        with open(text_path, 'r', encoding='utf-8') as f:
+            texts = json.load(f)
+        print(f"{file_key} 为旧格式数据，正在用 {self.model_name} 重新向量化")
+        save_embeddings(self.data_dir, file_key, texts, self.vectorize_text(texts),
+                        [{} for _ in texts], self.model_name)
+        return True
+    
+    def refresh(self):
+        """检查共享代数计数器，其他进程发布了新数据时重新挂载"""
+        changed = False
+        for file_key in self.processed_files:
+            if self.generations.get(file_key) != self.loaded_generations.get(file_key):
+                self.load_slot(file_key)
+                changed = True
+        if changed:
+            self.spec_index.load()
+        return changed
+    
+    def text_index_dir(self, file_key):
+        return os.path.join(self.data_dir, f'{file_key}_lexical')
+    
+    def load_text_index(self, file_key):
+        """加载倒排索引；旧数据没有索引或与文本块数量不一致时重新构建"""
+        index = InvertedIndex.load(self.text_index_dir(file_key))
+        text_chunks = self.processed_files[file_key]['text']
+        if len(index) != len(text_chunks):
+            index = InvertedIndex()
+            index.add(text_chunks)
+            index.save(self.text_index_dir(file_key))
+        self.text_indexes[file_key] = index
+    
+    def save_processed_data(self, file_key):
+        """将处理后的数据按统一格式保存到持久化存储（知识库可直接加载）"""
+        try:
+            # 倒排索引先落盘，向量清单最后发布（发布时递增代数，其他进程随之重新挂载）
+            self.text_indexes[file_key].save(self.text_index_dir(file_key))
+            save_embeddings(
+                self.data_dir, file_key,
+                self.processed_files[file_key]['text'],
+                self.processed_files[file_key]['vectors'],
+                self.processed_files[file_key]['metadata'],
+                self.model_name
+            )
             print(f"已保存 {file_key} 的处理数据")
             return True
         except Exception as e:
@@ -57,27 +145,56 @@ class PDFBatchProcessor:
             return False
     
     def process_uploaded_file(self, file_key, file_path):
-        """处理上传的PDF文件并保存结果"""
+        """
+        处理上传的PDF文件并保存结果。
+        同一槽位上传修订版时按页比较内容哈希：未变化的页面复用上次的文本和规格条目，
+        与已发布数据相同的文本块复用已有向量，只有变化的部分需要提取和向量化。
+        处理过程按批写入检查点，中途崩溃后再次处理同一文件时从上次完成的批次继续。
+        """
         try:
             print(f"开始处理文件: {file_path}")
-            # 读取和提取PDF文本
-            text_chunks = self.extract_text_from_pdf(file_path)
-            if not text_chunks:
+            checkpoint = IngestCheckpoint(self.data_dir, file_key, file_path)
+            # 以该槽位最新发布的数据作为复用基准
+            self.refresh()
+            pages = extract_pages(file_path, load_page_records(self.data_dir, file_key), checkpoint)
+            # 按页文本分块（带页码和章节信息）
+            chunks = chunk_page_texts([page['text'] for page in pages])
+            if not chunks:
                 print(f"无法从文件提取文本: {file_path}")
+                checkpoint.clear()
                 return False
+            text_chunks = [chunk['text'] for chunk in chunks]
+            metadata = [{key: value for key, value in chunk.items() if key != 'text'} for chunk in chunks]
             
             print(f"成功提取 {len(text_chunks)} 个文本块")
             
-            # 对文本进行向量化
-            vectors = self.vectorize_text(text_chunks)
-            print(f"向量化完成，生成 {len(vectors)} 个向量")
+            # 对文本进行向量化（复用未变化文本块的向量）
+            vectors = self.vectorize_incremental(file_key, text_chunks, checkpoint)
+            if len(vectors) != len(text_chunks):
+                return False
             
             # 存储处理后的结果
             self.processed_files[file_key]['text'] = text_chunks
             self.processed_files[file_key]['vectors'] = vectors
+            self.processed_files[file_key]['metadata'] = metadata
+            
+            # 重建该文件的倒排索引和元数据索引
+            self.text_indexes[file_key] = InvertedIndex()
+            self.text_indexes[file_key].add(text_chunks)
+            self.metadata_indexes[file_key] = MetadataIndex()
+            self.metadata_indexes[file_key].add(metadata)
+            
+            # 建立规格索引（失败不影响文本检索），需在发布前完成
+            self.build_spec_index(file_key, file_path, pages, checkpoint)
+            # 逐页记录按内容哈希寻址，先于向量发布写入也不会与旧数据冲突
+            save_page_records(self.data_dir, file_key, pages)
             
             # 保存处理结果
             success = self.save_processed_data(file_key)
+            if success:
+                # 改为挂载刚发布的共享数据，释放进程内的副本
+                self.load_slot(file_key)
+                checkpoint.clear()
             
             return success
         except Exception as e:
@@ -86,90 +203,178 @@ class PDFBatchProcessor:
             traceback.print_exc()
             return False
     
-    def extract_text_from_pdf(self, pdf_path, chars_per_chunk=1000):
-        """从PDF文件中提取文本，并按指定字符数分块"""
-        text_chunks = []
-        current_chunk = ""
-        
+    def resume_interrupted(self):
+        """继续处理上次中断的入库任务（检查点中记录了槽位和文件路径），返回继续处理的任务数"""
+        jobs = pending_jobs(self.data_dir)
+        for file_key, pdf_path in jobs:
+            if not os.path.exists(pdf_path):
+                print(f"未完成的入库任务找不到原文件，跳过: {pdf_path}")
+                continue
+            print(f"继续未完成的入库任务: {file_key} <- {pdf_path}")
+            self.process_uploaded_file(file_key, pdf_path)
+        return len(jobs)
+    
+    def process_directory(self, input_dir, output_dir=None, **kwargs):
+        """
+        批量入库目录树中的PDF（复用已加载的模型），默认写入网页端共用的数据目录。
+        参数见 bulk_ingest.ingest_directory，返回统计信息。
+        """
+        return ingest_directory(input_dir, output_dir or self.data_dir,
+                                model=self.model, model_name=self.model_name, **kwargs)
+    
+    def build_spec_index(self, file_key, file_path, pages=None, checkpoint=None):
+        """
+        提取尺寸/公差/材料条目并保存到规格索引。提取失败时该槽位保存为空条目，问题交给大模型回答。
+        传入页记录时只对没有缓存条目的页面运行pdfplumber，结果写回页记录供下次复用；
+        传入检查点时按批提取，每批完成后写入检查点。
+        """
         try:
-            # 使用PyPDF2打开PDF文件
-            with open(pdf_path, 'rb') as f:
-                reader = PdfReader(f)
-                
-                # 遍历每一页
-                for page in reader.pages:
-                    page_text = page.extract_text()
-                    if not page_text.strip():
-                        continue
-                        
-                    # 按段落拆分
-                    paragraphs = page_text.split('\n\n')
-                    
-                    for paragraph in paragraphs:
-                        # 如果段落为空，则跳过
-                        if not paragraph.strip():
-                            continue
-                        
-                        # 如果当前块加上新段落不超过限制，则添加到当前块
-                        if len(current_chunk) + len(paragraph) <= chars_per_chunk:
-                            current_chunk += paragraph + " "
-                        else:
-                            # 否则，保存当前块并开始新块
-                            if current_chunk:
-                                text_chunks.append(current_chunk.strip())
-                            current_chunk = paragraph + " "
-            
-            # 添加最后一个块
-            if current_chunk:
-                text_chunks.append(current_chunk.strip())
-                
-            return text_chunks
+            if pages is None:
+                entries = extract_specs_from_pdf(file_path)
+            else:
+                if checkpoint is not None:
+                    for number, page_entries in checkpoint.load_specs().items():
+                        if pages[number - 1]['specs'] is None:
+                            pages[number - 1]['specs'] = page_entries
+                todo = sorted(number for number, page in enumerate(pages, start=1) if page['specs'] is None)
+                for start in range(0, len(todo), PAGES_PER_SEGMENT):
+                    batch = todo[start:start + PAGES_PER_SEGMENT]
+                    batch_specs = {number: [] for number in batch}
+                    for entry in extract_specs_from_pdf(file_path, pages=set(batch)):
+                        batch_specs[entry['page']].append(entry)
+                    for number, page_entries in batch_specs.items():
+                        pages[number - 1]['specs'] = page_entries
+                    if checkpoint is not None:
+                        checkpoint.append_specs(batch[0], batch_specs)
+                # 复用的条目按页面在新版本中的位置更新页码
+                entries = [dict(entry, page=number)
+                           for number, page in enumerate(pages, start=1) for entry in page['specs']]
+            self.spec_index.save(file_key, entries)
+            print(f"规格索引完成，共 {len(entries)} 个条目")
+            return True
         except Exception as e:
-            print(f"提取PDF文本时出错: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return []
+            print(f"建立规格索引时出错: {str(e)}")
+            # 清空该槽位的条目：保留上一份图纸的规格会让查值/比对问题用旧图纸的数据作答
+            try:
+                self.spec_index.save(file_key, [])
+            except Exception as save_error:
+                print(f"清空规格索引时出错: {str(save_error)}")
+            return False
+    
+    def extract_text_from_pdf(self, pdf_path, chars_per_chunk=1000):
+        """从PDF文件中提取文本，并按指定字符数分块"""
+        return [chunk['text'] for chunk in self.extract_chunks_from_pdf(pdf_path, chars_per_chunk)]
+    
+    def extract_chunks_from_pdf(self, pdf_path, chars_per_chunk=1000):
+        """从PDF文件中提取文本并分块，每个块记录起止页码（从1开始）和所在章节"""
+        pages = extract_pages(pdf_path)
+        return chunk_page_texts([page['text'] for page in pages], chars_per_chunk)
     
     def vectorize_text(self, text_chunks):
         """将文本块转换为向量"""
         try:
-            # 使用sentence-transformers模型将文本转换为向量
-            vectors = self.model.encode(text_chunks, show_progress_bar=True)
-            return vectors
+            # 使用sentence-transformers模型将文本转换为归一化的float32向量
+            vectors = self.model.encode(text_chunks, show_progress_bar=True, normalize_embeddings=True)
+            return np.asarray(vectors, dtype=np.float32)
         except Exception as e:
             print(f"向量化文本时出错: {str(e)}")
             return []
     
-    def search_similar_text(self, query, file_key='file1', top_k=3, similarity_threshold=0.2):
-        """在指定文件中搜索与查询最相似的文本块"""
+    def vectorize_incremental(self, file_key, text_chunks, checkpoint=None):
+        """
+        向量化文本块，与该槽位已发布数据中文本相同的块直接复用已有向量。
+        修订版中分块边界只在变化页附近移动，因此只有少量文本块需要重新计算。
+        传入检查点时复用上次中断前已完成的批次，每 CHUNKS_PER_SEGMENT 个块写入一个检查点段。
+        """
+        old_texts = self.processed_files[file_key]['text']
+        old_vectors = self.processed_files[file_key]['vectors']
+        reusable = {}
+        if len(old_vectors) and len(old_vectors) == len(old_texts):
+            for row, text in enumerate(old_texts):
+                reusable.setdefault(text, row)
+        computed = checkpoint.load_vectors() if checkpoint is not None else {}
+        
+        missing = [text for text in dict.fromkeys(text_chunks) if text not in reusable and text not in computed]
+        if computed:
+            print(f"从检查点恢复 {len(computed)} 个已向量化的文本块")
+        for start in range(0, len(missing), CHUNKS_PER_SEGMENT):
+            batch = missing[start:start + CHUNKS_PER_SEGMENT]
+            batch_vectors = self.vectorize_text(batch)
+            if len(batch_vectors) != len(batch):
+                return []
+            computed.update(zip(batch, batch_vectors))
+            if checkpoint is not None:
+                checkpoint.append_vectors(batch, batch_vectors)
+        
+        if not computed:
+            vectors = np.asarray(old_vectors)[[reusable[text] for text in text_chunks]]
+            print(f"向量化完成，全部 {len(text_chunks)} 个文本块复用已有向量")
+            return np.ascontiguousarray(vectors, dtype=np.float32)
+        
+        dimension = len(next(iter(computed.values())))
+        vectors = np.empty((len(text_chunks), dimension), dtype=np.float32)
+        fresh = np.array([text in computed for text in text_chunks], dtype=bool)
+        if fresh.any():
+            vectors[fresh] = np.stack([computed[text] for text in text_chunks if text in computed])
+        if not fresh.all():
+            vectors[~fresh] = np.asarray(old_vectors)[[reusable[text] for text in text_chunks if text not in computed]]
+        print(f"向量化完成，生成 {len(vectors)} 个向量（新计算 {len(missing)} 个）")
+        return vectors
+    
+    def search_similar_text(self, query, file_key='file1', top_k=3, similarity_threshold=0.2, page=None, section=None):
+        """
+        在指定文件中混合检索（向量相似度 + BM25关键词）与查询最相关的文本块。
+        指定 page / section 时先用元数据索引筛出候选块，只对候选块打分。
+        """
         try:
+            self.refresh()
             text_chunks = self.processed_files[file_key]['text']
             vectors = self.processed_files[file_key]['vectors']
+            metadata = self.processed_files[file_key]['metadata']
             
-            if not text_chunks or len(vectors) == 0:
+            if not len(text_chunks) or len(vectors) == 0:
                 print(f"{file_key} 没有处理过的数据")
                 return []
             
+            candidates = self.metadata_indexes[file_key].candidates(page=page, section=section)
+            if candidates is not None and len(candidates) == 0:
+                print(f"{file_key} 中没有满足过滤条件的文本块: page={page}, section={section}")
+                return []
+            
+            # 关键词检索：零件号、图号等精确字符串
+            lexical_hits = self.text_indexes[file_key].search(query, top_k=top_k * 4, candidates=candidates)
+            bm25_scores = dict(lexical_hits)
+            
             # 向量化查询
             query_vector = self.model.encode([query])[0]
             
-            # 计算相似度
-            similarities = np.dot(vectors, query_vector) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector))
+            # 计算相似度（有过滤条件时只计算候选块）
+            candidate_ids = candidates if candidates is not None else np.arange(len(text_chunks))
+            candidate_vectors = np.asarray(vectors)[candidate_ids]
+            similarities = np.zeros(len(text_chunks), dtype=np.float32)
+            similarities[candidate_ids] = np.dot(candidate_vectors, query_vector) / (
+                np.linalg.norm(candidate_vectors, axis=1) * np.linalg.norm(query_vector))
+            
+            # 向量检索候选：只保留相似度超过阈值的结果
+            order = candidate_ids[similarities[candidate_ids].argsort()[-top_k * 4:][::-1]]
+            vector_ranking = [int(idx) for idx in order if similarities[idx] >= similarity_threshold]
             
-            # 获取前K个最相似的索引
-            top_indices = similarities.argsort()[-top_k:][::-1]
+            # 倒数排名融合两路结果
+            fused = reciprocal_rank_fusion([vector_ranking, [doc_id for doc_id, _ in lexical_hits]])
+            top_indices = sorted(fused, key=fused.get, reverse=True)[:top_k]
             
             # 构建结果
             results = []
             for idx in top_indices:
                 similarity = float(similarities[idx])
-                # 只返回相似度超过阈值的结果
-                if similarity >= similarity_threshold:
-                    results.append({
-                        'text': text_chunks[idx],
-                        'similarity': similarity
-                    })
-                    print(f"{file_key} - 找到匹配: 相似度={similarity:.4f}")
+                results.append({
+                    'text': text_chunks[idx],
+                    'metadata': metadata[idx] if idx < len(metadata) else {},
+                    'similarity': similarity,
+                    'bm25': bm25_scores.get(idx, 0.0),
+                    'score': fused[idx]
+                })
+                print(f"{file_key} - 找到匹配: 相似度={similarity:.4f}, BM25={bm25_scores.get(idx, 0.0):.4f}")
             
             return results
         except Exception as e:
@@ -0,0 +1,113 @@
+from PyPDF2 import PdfReader  # 使用PyPDF2代替PyMuPDF
+
+try:
+    from .chunk_metadata import detect_section
+    from .page_records import page_hash, text_hash
+    from .ingest_checkpoint import PAGES_PER_SEGMENT
+except ImportError:
+    from chunk_metadata import detect_section
+    from page_records import page_hash, text_hash
+    from ingest_checkpoint import PAGES_PER_SEGMENT
+
+
+def extract_pages(pdf_path, previous=(), checkpoint=None):
+    """
+    逐页计算内容哈希并提取文本，返回页记录列表 [{'hash', 'text', 'specs'}]。
+    哈希与 previous 中某页相同的页面直接复用已提取的文本和规格条目（页面移动位置也能命中）。
+    传入检查点时从已完成的页继续，每 PAGES_PER_SEGMENT 页写入一个检查点段。
+    """
+    known = {page['hash']: page for page in previous}
+    pages = checkpoint.load_pages() if checkpoint is not None else []
+    if pages:
+        print(f"从检查点恢复，已完成 {len(pages)} 页")
+    saved = len(pages)
+    extracted = 0
+    stream_cache = {}
+
+    try:
+        # 使用PyPDF2打开PDF文件
+        with open(pdf_path, 'rb') as f:
+            reader = PdfReader(f)
+
+            for page_number in range(len(pages), len(reader.pages)):
+                page = reader.pages[page_number]
+                text = None
+                try:
+                    digest = page_hash(page, stream_cache)
+                except Exception as e:
+                    # 哈希只用于复用，计算失败时按文本计算，不能让入库因此失败
+                    print(f"计算第 {page_number + 1} 页哈希时出错，改用文本哈希: {str(e)}")
+                    text = page.extract_text() or ''
+                    digest = text_hash(text)
+                cached = known.get(digest)
+                if cached is not None:
+                    pages.append({'hash': digest, 'text': cached['text'], 'specs': cached.get('specs')})
+                else:
+                    if text is None:
+                        text = page.extract_text() or ''
+                    pages.append({'hash': digest, 'text': text, 'specs': None})
+                    extracted += 1
+                if checkpoint is not None and len(pages) - saved >= PAGES_PER_SEGMENT:
+                    checkpoint.append_pages(saved, pages[saved:])
+                    saved = len(pages)
+
+            if checkpoint is not None and len(pages) > saved:
+                checkpoint.append_pages(saved, pages[saved:])
+
+        if previous:
+            print(f"共 {len(pages)} 页，其中 {extracted} 页有变化需要重新提取")
+        return pages
+    except Exception as e:
+        print(f"提取PDF文本时出错: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return []
+
+
+def chunk_page_texts(page_texts, chars_per_chunk=1000):
+    """把逐页文本按指定字符数分块，页码从1开始"""
+    text_chunks = []
+    current_chunk = ""
+    chunk_meta = {}
+    section = None
+
+    # 遍历每一页
+    for page_number, page_text in enumerate(page_texts, start=1):
+        if not page_text.strip():
+            continue
+
+        # 按段落拆分
+        paragraphs = page_text.split('\n\n')
+
+        for paragraph in paragraphs:
+            # 如果段落为空，则跳过
+            if not paragraph.strip():
+                continue
+
+            # 如果当前块加上新段落不超过限制，则添加到当前块
+            if current_chunk and len(current_chunk) + len(paragraph) <= chars_per_chunk:
+                current_chunk += paragraph + " "
+                chunk_meta['page_end'] = page_number
+                section = update_section(paragraph, section)
+            else:
+                # 否则，保存当前块并开始新块
+                if current_chunk:
+                    text_chunks.append(dict(chunk_meta, text=current_chunk.strip()))
+                current_chunk = paragraph + " "
+                section = update_section(paragraph, section)
+                chunk_meta = {'page_start': page_number, 'page_end': page_number, 'section': section}
+
+    # 添加最后一个块
+    if current_chunk:
+        text_chunks.append(dict(chunk_meta, text=current_chunk.strip()))
+
+    return text_chunks
+
+
+def update_section(paragraph, section):
+    """段落中出现章节标题时更新当前章节"""
+    for line in paragraph.split('\n'):
+        heading = detect_section(line)
+        if heading:
+            section = heading
+    return section
@@ -0,0 +1,108 @@
+import os
+import mmap
+import zlib
+from collections.abc import Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境没有 fcntl
+    fcntl = None
+
+GENERATION_FILE = 'generations.bin'
+GENERATION_SLOTS = 64
+# 网页端挂载的槽位使用固定位置，其余键（如批量入库的 doc_*）散列到剩余位置，不会引起网页端误重载
+RESERVED_GENERATION_SLOTS = {'file1': 0, 'file2': 1}
+
+
+def _atomic_write_bytes(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class GenerationCounter:
+    """
+    多进程共享的代数计数器，保存在 processed_data/generations.bin 中并以 mmap 映射。
+    入库进程发布新数据后递增对应文件的代数，其他 worker 读取计数器（不需要系统调用）
+    发现代数变化时重新挂载数据。
+    """
+
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, GENERATION_FILE)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < GENERATION_SLOTS * 8:
+                os.ftruncate(fd, GENERATION_SLOTS * 8)
+            self._mmap = mmap.mmap(fd, GENERATION_SLOTS * 8)
+        finally:
+            os.close(fd)
+        self.counters = np.frombuffer(self._mmap, dtype=np.uint64)
+
+    @staticmethod
+    def _slot(file_key):
+        if file_key in RESERVED_GENERATION_SLOTS:
+            return RESERVED_GENERATION_SLOTS[file_key]
+        reserved = len(RESERVED_GENERATION_SLOTS)
+        return reserved + zlib.crc32(file_key.encode('utf-8')) % (GENERATION_SLOTS - reserved)
+
+    def get(self, file_key):
+        return int(self.counters[self._slot(file_key)])
+
+    def bump(self, file_key):
+        """递增代数；用文件锁保证多个入库进程同时发布时不丢失更新"""
+        with open(self.path, 'rb+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                slot = self._slot(file_key)
+                self.counters[slot] += 1
+                self._mmap.flush()
+                return int(self.counters[slot])
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_text_blob(data_dir, prefix, texts):
+    """
+    把文本块写成一个UTF-8数据文件加偏移数组，供各进程以mmap共享读取。
+    文件名为 <prefix>_text.bin / <prefix>_text_offsets.npy，返回这两个文件名。
+    """
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in encoded], out=offsets[1:])
+    blob_file = f'{prefix}_text.bin'
+    offsets_file = f'{prefix}_text_offsets.npy'
+    _atomic_write_bytes(os.path.join(data_dir, blob_file), b''.join(encoded))
+    tmp_path = os.path.join(data_dir, f'{offsets_file}.{os.getpid()}.tmp.npy')
+    np.save(tmp_path, offsets)
+    os.replace(tmp_path, os.path.join(data_dir, offsets_file))
+    return blob_file, offsets_file
+
+
+class SharedTexts(Sequence):
+    """以mmap方式只读访问文本块，按需解码单个块，不在每个进程中保存整份文本"""
+
+    def __init__(self, blob_path, offsets_path):
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        if os.path.getsize(blob_path) == 0:
+            self._blob = b''
+        else:
+            with open(blob_path, 'rb') as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return self._blob[start:end].decode('utf-8')
@@ -0,0 +1,76 @@
+import re
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+def normalize_question(question):
+    """合并空白、去掉首尾空白，使仅空格不同的问题视为同一个问题"""
+    return re.sub(r'\s+', ' ', question).strip()
+
+
+class SingleFlight:
+    """
+    请求合并：相同键的并发请求只执行一次计算，所有等待者共享同一个结果（或异常）。
+    计算完成后立即移除，不做结果缓存。
+    进行中的计算以 concurrent.futures.Future 登记在同一张表中，同步调用（线程）和异步调用都在其上等待，
+    因此不同线程、不同事件循环（如WSGI下每个请求各自的循环）中的相同请求也能合并。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # 异步领头者创建的任务，保持引用直到完成
+        self._tasks = set()
+
+    def _join(self, key):
+        """返回 (future, 是否为领头者)；领头者负责计算并设置结果"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            # 置为运行中：等待者取消时（见 do_async）不会连带取消这次计算
+            future.set_running_or_notify_cancel()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        future, leader = self._join(key)
+        if leader:
+            task = asyncio.get_running_loop().create_task(fn(*args, **kwargs))
+            self._tasks.add(task)
+            task.add_done_callback(lambda done: self._task_done(key, future, done))
+        # 领头者的请求被取消（如客户端断开）时计算继续进行，不影响其他等待者
+        return await asyncio.wrap_future(future)
+
+    def _task_done(self, key, future, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            # 领头者所在的事件循环关闭时任务会被取消，其他等待者随之收到 CancelledError
+            self._finish(key, future, error=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, future, error=task.exception())
+        else:
+            self._finish(key, future, task.result())
@@ -0,0 +1,295 @@
+import os
+import re
+import json
+
+# 长度单位换算为毫米
+UNIT_TO_MM = {'mm': 1.0, 'cm': 10.0, 'm': 1000.0, 'um': 0.001, 'μm': 0.001}
+
+# 尺寸：可选标签 + 可选直径/半径符号 + 数值 + 单位 + 可选公差
+DIMENSION_RE = re.compile(
+    r'(?P<label>[一-龥A-Za-z]{2,12}?)?\s*[:：=]?\s*'
+    r'(?P<prefix>[ΦφØ⌀R])?\s*'
+    r'(?P<value>\d+(?:\.\d+)?)\s*'
+    r'(?P<unit>mm|cm|μm|um|m(?![a-zA-Z])|°)?\s*'
+    r'(?:(?:±|\+/-|\+-)\s*(?P<tol>\d+(?:\.\d+)?)'
+    r'|\+\s*(?P<plus>\d+(?:\.\d+)?)\s*/?\s*-\s*(?P<minus>\d+(?:\.\d+)?))?'
+)
+
+# 常见材料牌号
+MATERIAL_RE = re.compile(
+    r'(?P<label>材料|材质|牌号)?\s*[:：]?\s*'
+    r'(?P<grade>Q\d{3}[A-E]?|\d{2}Cr\d*Mo\w*|\d{2}Cr\w*|0?Cr\d+Ni\d+\w*|[34]\d{2}L?不锈钢|\d{2}#|ZG\d+-\d+|H\d{2,3}|TC4|TA2)'
+)
+
+# 标准编号，如 GB/T 12345-2008
+STANDARD_RE = re.compile(r'(?P<grade>(?:GB/T|GB|JB/T|CB/T|CB|ISO)\s*\d+(?:\.\d+)?(?:-\d{4})?)')
+
+# 只有明确查值或比对的问题才直接用索引回答，解释、总结类问题仍交给大模型
+VALUE_QUESTION_RE = re.compile(r'多少|几[个号度]?|数值|取值|是什么|哪个|哪种|哪些')
+COMPARE_QUESTION_RE = re.compile(r'是否|合规|符合|对比|比对|比较|一致|差异|不同|超差|超出')
+EXPLAIN_QUESTION_RE = re.compile(r'为什么|为何|原因|理由|解释|说明|总结|概括|概述|介绍|分析|如何|怎么|影响|作用|意义')
+ERROR_TYPES = {'dimension': '尺寸误差', 'material': '材料不符', 'standard': '标准不符'}
+
+
+def _to_mm(value, unit):
+    return value * UNIT_TO_MM.get(unit, 1.0)
+
+
+def _format_entry(entry):
+    """把索引条目还原为便于阅读的字符串"""
+    if entry['kind'] != 'dimension':
+        return entry['value']
+    text = f"{entry.get('prefix') or ''}{entry['value']:g}{entry['unit'] or ''}"
+    plus, minus = entry.get('tol_plus'), entry.get('tol_minus')
+    if plus is not None and plus == minus:
+        text += f" ±{plus:g}"
+    elif plus is not None:
+        text += f" +{plus:g}/-{minus:g}"
+    return text
+
+
+def parse_specs(text, page):
+    """从一段文本中解析尺寸/公差/材料条目"""
+    entries = []
+    for match in DIMENSION_RE.finditer(text):
+        unit = match.group('unit')
+        prefix = match.group('prefix')
+        tol = match.group('tol')
+        plus, minus = match.group('plus'), match.group('minus')
+        # 没有单位、公差或直径符号的数字不当作尺寸（避免把页码、序号收进来）
+        if not (unit or tol or plus or prefix):
+            continue
+        label = (match.group('label') or '').strip()
+        if not label:
+            continue
+        entry = {
+            'kind': 'dimension',
+            'label': label,
+            'prefix': prefix,
+            'value': float(match.group('value')),
+            'unit': unit or 'mm',
+            'tol_plus': float(tol or plus) if (tol or plus) else None,
+            'tol_minus': float(tol or minus) if (tol or minus) else None,
+            'raw': match.group(0).strip(),
+            'page': page,
+        }
+        entries.append(entry)
+
+    for regex, kind in ((MATERIAL_RE, 'material'), (STANDARD_RE, 'standard')):
+        for match in regex.finditer(text):
+            if kind == 'standard':
+                label = '标准'
+            else:
+                # 材料条目以前面的中文作为标签，如“壳体材料Q345B”
+                start = match.start('grade')
+                context = re.findall(r'[一-龥]{2,12}', text[max(0, start - 12):start])
+                label = context[-1] if context else '材料'
+            entries.append({
+                'kind': kind,
+                'label': label,
+                'value': re.sub(r'\s+', ' ', match.group('grade')),
+                'raw': match.group(0).strip(),
+                'page': page,
+            })
+    return entries
+
+
+def extract_specs_from_pdf(pdf_path, pages=None):
+    """
+    使用pdfplumber逐页提取规格条目。
+    表格按行拼接成“标签 值”后再解析，保证表格中的尺寸也能带上标签。
+    指定 pages（页码集合，从1开始）时只处理这些页。
+    """
+    import pdfplumber
+
+    entries = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_number, page in enumerate(pdf.pages, start=1):
+            if pages is not None and page_number not in pages:
+                continue
+            for table in page.extract_tables() or []:
+                for row in table:
+                    cells = [str(cell).strip() for cell in row if cell]
+                    if len(cells) >= 2:
+                        entries.extend(parse_specs(' '.join(cells), page_number))
+            text = page.extract_text() or ''
+            entries.extend(parse_specs(text, page_number))
+            page.flush_cache()
+    return _dedupe(entries)
+
+
+def _dedupe(entries):
+    seen = set()
+    result = []
+    for entry in entries:
+        key = (entry['kind'], entry['label'], str(entry['value']), entry['page'])
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(entry)
+    return result
+
+
+class SpecIndex:
+    """
+    按文件和标签组织的规格索引，用于无需调用大模型的精确查值和比对。
+    file1 视为待校对图纸，file2 视为标准/参考图纸。
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        # {file_key: {label: [entry, ...]}}
+        # 发布后不再原地修改：加载/保存时构建新字典再整体替换，其他线程中的 answer() 不会读到一半的索引
+        self.by_label = {}
+
+    def spec_path(self, file_key):
+        return os.path.join(self.data_dir, f'{file_key}_specs.json')
+
+    def load(self, file_keys=('file1', 'file2')):
+        """从持久化存储加载规格条目"""
+        by_label = {}
+        for file_key in file_keys:
+            path = self.spec_path(file_key)
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    by_label[file_key] = self._group(json.load(f))
+            except Exception as e:
+                print(f"加载规格索引时出错: {str(e)}")
+        self.by_label = by_label
+        return self
+
+    def save(self, file_key, entries):
+        """保存某个文件的规格条目并更新内存索引"""
+        # 先写临时文件再替换，写入中途崩溃不会留下半个文件
+        tmp_path = f'{self.spec_path(file_key)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.spec_path(file_key))
+        self.by_label = dict(self.by_label, **{file_key: self._group(entries)})
+
+    def add_entries(self, file_key, entries):
+        labels = {label: list(items) for label, items in self.by_label.get(file_key, {}).items()}
+        for label, items in self._group(entries).items():
+            labels.setdefault(label, []).extend(items)
+        self.by_label = dict(self.by_label, **{file_key: labels})
+
+    @staticmethod
+    def _group(entries):
+        labels = {}
+        for entry in entries:
+            labels.setdefault(entry['label'], []).append(entry)
+        return labels
+
+    def labels(self):
+        result = set()
+        for labels in self.by_label.values():
+            result.update(labels)
+        return result
+
+    def match_labels(self, question):
+        """找出问题中出现的标签，较长的标签优先，被更长标签包含的短标签忽略"""
+        found = []
+        for label in sorted(self.labels(), key=len, reverse=True):
+            if len(label) >= 2 and label in question and not any(label in longer for longer in found):
+                found.append(label)
+        return found
+
+    def lookup(self, label, file_key=None, page=None):
+        """按标签（子串匹配）查找规格条目，可限定文件和页码"""
+        results = []
+        for key, labels in self.by_label.items():
+            if file_key and key != file_key:
+                continue
+            for entry_label, entries in labels.items():
+                if label not in entry_label:
+                    continue
+                for entry in entries:
+                    if page is None or entry['page'] == page:
+                        results.append(dict(entry, file_key=key))
+        return results
+
+    def compare(self, label=None, file_key='file1', reference_key='file2'):
+        """
+        对比两个文件中同名标签的数值，返回超出公差或材料不一致的差异，
+        输出格式与知识库比对结果中的 differences 一致。
+        """
+        current = self.by_label.get(file_key, {})
+        reference = self.by_label.get(reference_key, {})
+        differences = []
+        for entry_label in sorted(set(current) & set(reference)):
+            if label and label not in entry_label:
+                continue
+            for cur in current[entry_label]:
+                refs = [ref for ref in reference[entry_label] if ref['kind'] == cur['kind']]
+                if not refs:
+                    continue
+                if any(self._within(cur, ref) for ref in refs):
+                    continue
+                ref = refs[0]
+                differences.append({
+                    'position': f"Page{cur['page']}",
+                    'error_type': ERROR_TYPES[cur['kind']],
+                    'original_value': f"{entry_label}{_format_entry(cur)}",
+                    'expected_value': f"{_format_entry(ref)} (Page{ref['page']})",
+                    'confidence': 1.0,
+                })
+        return differences
+
+    @staticmethod
+    def _within(entry, reference):
+        """判断条目是否满足参考值（含公差）"""
+        if entry['kind'] != 'dimension':
+            return entry['value'] == reference['value']
+        if (entry['unit'] == '°') != (reference['unit'] == '°'):
+            return False
+        value = _to_mm(entry['value'], entry['unit'])
+        expected = _to_mm(reference['value'], reference['unit'])
+        # 参考值没有公差时用待校对值自身的公差
+        tol_source = reference if reference.get('tol_plus') is not None else entry
+        plus = _to_mm(tol_source.get('tol_plus') or 0.0, tol_source['unit'])
+        minus = _to_mm(tol_source.get('tol_minus') or 0.0, tol_source['unit'])
+        return expected - minus - 1e-9 <= value <= expected + plus + 1e-9
+
+    def answer(self, question):
+        """
+        尝试直接用索引回答问题。
+        只有问题明确在查值（多少/是什么…）或比对（是否/合规/对比…）且出现已知标签时才回答，
+        其他问题（如“为什么选用这个标准”）返回 None，由调用方交给大模型处理。
+        """
+        if EXPLAIN_QUESTION_RE.search(question):
+            return None
+        wants_compare = bool(COMPARE_QUESTION_RE.search(question))
+        if not (wants_compare or VALUE_QUESTION_RE.search(question)):
+            return None
+        labels = self.match_labels(question)
+        if not labels:
+            return None
+        page_match = re.search(r'第\s*(\d+)\s*页', question)
+        page = int(page_match.group(1)) if page_match else None
+
+        lines = []
+        for label in labels:
+            for file_key in sorted(self.by_label):
+                entries = self.lookup(label, file_key=file_key, page=page)
+                if entries:
+                    values = '；'.join(f"{_format_entry(e)}（第{e['page']}页）" for e in entries)
+                    lines.append(f"- **{label}** [{file_key}]: {values}")
+        if not lines:
+            return None
+
+        if not wants_compare:
+            return "\n".join(lines)
+
+        differences = []
+        for label in labels:
+            differences.extend(self.compare(label))
+        if differences:
+            lines.append("\n**超差/不一致项：**")
+            for diff in differences:
+                lines.append(f"- {diff['position']} {diff['error_type']}: "
+                             f"{diff['original_value']}，参考值 {diff['expected_value']}")
+        elif len(self.by_label) > 1:
+            lines.append("\n两份文档中的上述数值在公差范围内一致。")
+        return "\n".join(lines)
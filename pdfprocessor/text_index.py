@@ -0,0 +1,236 @@
+import os
+import re
+import json
+import uuid
+import numpy as np
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 每个段中以内存映射方式加载的数组（另有 doc_lens 直接读入内存）
+SEGMENT_ARRAYS = ('terms', 'term_offsets', 'postings_offsets', 'doc_ids', 'tfs')
+# 倒数排名融合（RRF）的平滑常数
+RRF_K = 60
+
+CJK_RE = re.compile(r'[一-鿿]+')
+# 零件号、图号、规格字符串，如 GB/T12345、A-102.3、Q345B
+ALNUM_RE = re.compile(r'[A-Za-z0-9]+(?:[-./][A-Za-z0-9]+)*')
+
+
+def tokenize(text):
+    """中文按字符二元组切分，字母数字串保留整体并补充各组成部分"""
+    tokens = []
+    for run in CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    for match in ALNUM_RE.findall(text):
+        token = match.lower()
+        tokens.append(token)
+        parts = re.split(r'[-./]', token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """融合多个排好序的结果列表，返回 {doc_id: score}"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+
+def _vocab_arrays(terms, postings_offsets):
+    """
+    把按UTF-8字节序排好的词表编码为紧凑数组：
+    terms（所有词的UTF-8字节拼接）、term_offsets（每个词在 terms 中的起止位置）、
+    postings_offsets（每个词的倒排表在 doc_ids/tfs 中的起止位置）。
+    三个数组都可以直接内存映射，各进程不需要把词表解析成Python字典。
+    """
+    encoded = [term.encode('utf-8') for term in terms]
+    term_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in encoded], out=term_offsets[1:])
+    return {
+        'terms': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'term_offsets': term_offsets,
+        'postings_offsets': np.asarray(postings_offsets, dtype=np.int64),
+    }
+
+
+def _lookup(segment, term):
+    """在段的词表中二分查找一个词（已编码为UTF-8），返回倒排表的 (start, count)，不存在时返回 None"""
+    terms, offsets = segment['terms'], segment['term_offsets']
+    lo, hi = 0, len(offsets) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if terms[offsets[mid]:offsets[mid + 1]].tobytes() < term:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == len(offsets) - 1 or terms[offsets[lo]:offsets[lo + 1]].tobytes() != term:
+        return None
+    start = int(segment['postings_offsets'][lo])
+    return start, int(segment['postings_offsets'][lo + 1]) - start
+
+
+def _build_segment(texts):
+    """把一批文本构建为紧凑的倒排段：有序词表 + 连续存放的倒排表"""
+    postings = {}
+    doc_lens = np.zeros(len(texts), dtype=np.int32)
+    for doc_id, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_lens[doc_id] = len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            postings.setdefault(token, []).append((doc_id, tf))
+
+    # 按UTF-8字节排序，与 _lookup 中的字节比较一致
+    terms = sorted(postings, key=lambda token: token.encode('utf-8'))
+    postings_offsets = [0]
+    doc_ids = []
+    tfs = []
+    for token in terms:
+        entries = postings[token]
+        doc_ids.extend(doc_id for doc_id, _ in entries)
+        tfs.extend(tf for _, tf in entries)
+        postings_offsets.append(len(doc_ids))
+    return {
+        **_vocab_arrays(terms, postings_offsets),
+        'doc_ids': np.asarray(doc_ids, dtype=np.int32),
+        'tfs': np.asarray(tfs, dtype=np.uint16 if not tfs or max(tfs) < 65536 else np.uint32),
+        'doc_lens': doc_lens,
+    }
+
+
+class InvertedIndex:
+    """
+    按段追加的BM25倒排索引。
+    每次入库追加一个不可变段，保存后词表和倒排表都以内存映射方式加载，
+    查询时二分查找词表，只读取命中词的倒排表。
+    """
+
+    def __init__(self):
+        self.segments = []
+        self._doc_lens = None
+
+    def __len__(self):
+        return sum(len(segment['doc_lens']) for segment in self.segments)
+
+    def add(self, texts):
+        """追加一批文本，文档编号从当前文档总数开始连续分配"""
+        if not texts:
+            return
+        segment = _build_segment(texts)
+        segment['base'] = len(self)
+        segment['name'] = None
+        self.segments.append(segment)
+        self._doc_lens = None
+
+    def reset(self):
+        self.segments = []
+        self._doc_lens = None
+
+    def doc_lens(self):
+        """所有段的文档长度（缓存，供BM25长度归一化使用）"""
+        if self._doc_lens is None:
+            self._doc_lens = np.concatenate([segment['doc_lens'] for segment in self.segments]).astype(np.float32)
+        return self._doc_lens
+
+    def save(self, index_dir):
+        """保存索引；已落盘的段不会重复写入"""
+        os.makedirs(index_dir, exist_ok=True)
+        names = []
+        for i, segment in enumerate(self.segments):
+            if segment['name'] is None:
+                # 段名带随机后缀，重建索引时写入新文件，不会截断其他进程正在映射的旧文件
+                segment['name'] = f'seg{i}_{segment["base"]}_{uuid.uuid4().hex[:8]}'
+                prefix = os.path.join(index_dir, segment['name'])
+                for field in SEGMENT_ARRAYS + ('doc_lens',):
+                    np.save(f'{prefix}_{field}.npy', segment[field])
+            names.append({'name': segment['name'], 'base': segment['base']})
+
+        tmp_path = os.path.join(index_dir, f'manifest.json.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'segments': names}, f)
+        os.replace(tmp_path, os.path.join(index_dir, 'manifest.json'))
+        self._remove_stale_segments(index_dir, {item['name'] for item in names})
+
+    @staticmethod
+    def _remove_stale_segments(index_dir, keep):
+        for filename in os.listdir(index_dir):
+            if filename.startswith('seg') and not any(filename.startswith(f'{name}_') for name in keep):
+                os.remove(os.path.join(index_dir, filename))
+
+    @classmethod
+    def load(cls, index_dir):
+        """以内存映射方式加载索引，目录不存在时返回空索引"""
+        index = cls()
+        manifest_path = os.path.join(index_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return index
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        for item in manifest['segments']:
+            prefix = os.path.join(index_dir, item['name'])
+            segment = {field: np.load(f'{prefix}_{field}.npy', mmap_mode='r') for field in SEGMENT_ARRAYS}
+            # 文档长度每次查询都要整体使用，直接读入内存
+            segment['doc_lens'] = np.load(f'{prefix}_doc_lens.npy')
+            segment['base'] = item['base']
+            segment['name'] = item['name']
+            index.segments.append(segment)
+        return index
+
+    def search(self, query, top_k=10, candidates=None):
+        """
+        BM25检索，返回按得分降序的 [(doc_id, score), ...]。
+        candidates（文档编号数组）限定检索范围：倒排表先按候选集过滤再打分，只为候选文档分配得分。
+        """
+        total_docs = len(self)
+        terms = {term.encode('utf-8') for term in tokenize(query)}
+        if not total_docs or not terms:
+            return []
+
+        if candidates is not None:
+            candidates = np.unique(np.asarray(candidates, dtype=np.int64))
+            if len(candidates) == 0:
+                return []
+        # 得分数组按“候选集中的位置”索引，没有候选集时就是文档编号
+        doc_ids = candidates if candidates is not None else np.arange(total_docs)
+        doc_lens = self.doc_lens()
+        avg_len = float(doc_lens.mean()) or 1.0
+        scores = np.zeros(len(doc_ids), dtype=np.float32)
+
+        for term in terms:
+            hits = [(segment, posting) for segment in self.segments
+                    for posting in [_lookup(segment, term)] if posting is not None]
+            if not hits:
+                continue
+            # 文档频率按全部文档统计，过滤不改变idf
+            df = sum(count for _, (_, count) in hits)
+            idf = np.log(1.0 + (total_docs - df + 0.5) / (df + 0.5))
+            for segment, (start, count) in hits:
+                ids = np.asarray(segment['doc_ids'][start:start + count], dtype=np.int64) + segment['base']
+                tf = np.asarray(segment['tfs'][start:start + count], dtype=np.float32)
+                if candidates is not None:
+                    positions = np.minimum(np.searchsorted(candidates, ids), len(candidates) - 1)
+                    keep = candidates[positions] == ids
+                    if not keep.any():
+                        continue
+                    ids, tf, slots = ids[keep], tf[keep], positions[keep]
+                else:
+                    slots = ids
+                norm = BM25_K1 * (1.0 - BM25_B + BM25_B * doc_lens[ids] / avg_len)
+                scores[slots] += idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+        hit_slots = np.nonzero(scores)[0]
+        if len(hit_slots) == 0:
+            return []
+        if len(hit_slots) > top_k:
+            hit_slots = hit_slots[np.argpartition(-scores[hit_slots], top_k)[:top_k]]
+        hit_slots = hit_slots[np.argsort(-scores[hit_slots])]
+        return [(int(doc_ids[slot]), float(scores[slot])) for slot in hit_slots]